@@ -0,0 +1,9 @@
+""" Benchmarks of export, fill missing, mail and PDF code paths.
+
+Benchmarks run offline: data is generated in in-memory SQLite database,
+mail is sent to locmem backend and to local SMTP server. Run them with::
+
+    make bench
+
+or ``python benchmarks/run.py --help`` for options.
+"""
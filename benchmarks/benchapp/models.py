@@ -0,0 +1,59 @@
+""" Synthetic models, on which benchmarks are run.
+"""
+
+
+import datetime
+
+from django.db import models
+
+
+class School(models.Model):
+    """ School.
+    """
+
+    title = models.CharField(max_length=80)
+    city = models.CharField(max_length=80, blank=True)
+
+    def __unicode__(self):
+        return self.title
+
+
+class Student(models.Model):
+    """ Student, who is related to school.
+    """
+
+    first_name = models.CharField(max_length=45)
+    last_name = models.CharField(max_length=45)
+    email = models.EmailField(max_length=128, unique=True)
+    birth_date = models.DateField(null=True, blank=True)
+    school = models.ForeignKey(School)
+
+    class Meta(object):
+        ordering = ['last_name', 'first_name']
+
+    def __unicode__(self):
+        return u'{0.first_name} {0.last_name}'.format(self)
+
+
+def populate(size, schools=50):
+    """ Replaces contents of tables with ``size`` students.
+    """
+    Student.objects.all().delete()
+    School.objects.all().delete()
+    School.objects.bulk_create([
+        School(title=u'School {0}'.format(i), city=u'City {0}'.format(i % 7))
+        for i in range(schools)])
+    school_ids = list(School.objects.values_list('id', flat=True))
+    students = []
+    first_birth_date = datetime.date(1995, 1, 1)
+    for i in range(size):
+        students.append(Student(
+            first_name=u'First{0}'.format(i),
+            last_name=u'Last{0:06d}'.format(size - i),
+            email=u'student{0}@example.com'.format(i),
+            birth_date=first_birth_date + datetime.timedelta(i % 3650),
+            school_id=school_ids[i % len(school_ids)]))
+        if len(students) >= 500:
+            Student.objects.bulk_create(students)
+            students = []
+    Student.objects.bulk_create(students)
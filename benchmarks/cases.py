@@ -0,0 +1,278 @@
+""" Benchmark cases.
+
+Each case is set up for data size (number of students in database) and
+processes ``size * scale`` items (rows, messages or document rows) in
+one run.
+"""
+
+
+import datetime
+import os
+import tempfile
+
+from django.contrib import admin
+from django.core import mail as django_mail
+from django.core.files import File
+
+from pysheets.sheet import Sheet
+
+from nmadb_utils import export
+from nmadb_utils import fill
+from nmadb_utils import mail
+from nmadb_utils import pdf
+from nmadb_utils.admin import ModelAdmin
+
+from benchmarks.benchapp.models import Student
+from benchmarks.smtp import LocalSMTPServer
+
+
+SHEET_MAPPING = [
+        (u'First name', [u'first_name']),
+        (u'Last name', [u'last_name']),
+        (u'E-mail', [u'email']),
+        (u'Birth date', [u'birth_date']),
+        (u'School', [u'school', u'title']),
+        (u'City', [u'school', u'city']),
+        ]
+
+# Every n-th row of uploaded sheet is not found in database.
+MISSING_EVERY = 10
+
+
+class StudentAdmin(ModelAdmin):
+    """ Admin, which actions are measured.
+    """
+
+    sheet_mapping = SHEET_MAPPING
+
+
+def consume(response):
+    """ Reads response and returns its size in bytes.
+    """
+    if getattr(response, 'streaming', False):
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+def get_uploaded_emails(items):
+    """ Returns list of e-mails of uploaded sheet with ``items`` rows.
+    """
+    emails = list(Student.objects.order_by('id').values_list(
+        'email', flat=True)[:items])
+    for i in range(0, len(emails), MISSING_EVERY):
+        emails[i] = u'missing{0}@example.com'.format(i)
+    return emails
+
+
+class Case(object):
+    """ Benchmark case.
+    """
+
+    name = None
+    # Number of items processed per unit of data size.
+    scale = 1.0
+
+    def get_items(self, size):
+        """ Returns number of items processed in one run.
+        """
+        return max(1, int(size * self.scale))
+
+    def setup(self, size, items):
+        """ Prepares data for runs.
+        """
+
+    def run(self):
+        """ Runs measured code once.
+
+        :returns: size of output in bytes or ``None``.
+        """
+        raise NotImplementedError()
+
+    def teardown(self):
+        """ Releases resources allocated by :meth:`setup`.
+        """
+
+
+class DownloadSelectedCase(Case):
+    """ Download of all students with ``download_selected``.
+    """
+
+    def __init__(self, writer_type, streaming):
+        self.writer_type = writer_type
+        self.streaming = streaming
+        self.name = u'download_selected[{0}{1}]'.format(
+                writer_type, u',streaming' if streaming else u'')
+        self.model_admin = None
+
+    def setup(self, size, items):
+        self.model_admin = StudentAdmin(Student, admin.site)
+        self.model_admin.download_streaming = self.streaming
+
+    def run(self):
+        return consume(self.model_admin.download_selected(
+            Student.objects.all(), self.writer_type))
+
+
+class DumpQueryToSheetCase(Case):
+    """ Dump of all students into in memory sheet.
+    """
+
+    name = u'dump_query_to_sheet'
+
+    def __init__(self):
+        self.model_admin = None
+
+    def setup(self, size, items):
+        self.model_admin = StudentAdmin(Student, admin.site)
+
+    def run(self):
+        self.model_admin.dump_query_to_sheet(
+                Student.objects.all(), SHEET_MAPPING)
+
+
+class GenerateSpreadsheetCase(Case):
+    """ Filling of uploaded sheet, which is parsed into memory.
+    """
+
+    name = u'generate_spreadsheet'
+
+    def __init__(self):
+        self.model_admin = None
+        self.sheet = None
+
+    def setup(self, size, items):
+        self.model_admin = StudentAdmin(Student, admin.site)
+        self.sheet = Sheet(u'Data', [u'E-mail', u'Comment'])
+        for email in get_uploaded_emails(items):
+            self.sheet.append_iterable([email, u'comment'])
+
+    def run(self):
+        spreadsheet = self.model_admin.generate_spreadsheet(
+                Student, SHEET_MAPPING, [self.sheet])
+        for sheet in spreadsheet:
+            for row in sheet:
+                pass
+
+
+class StreamFilledCSVCase(Case):
+    """ Filling of uploaded CSV file, which is read row by row.
+    """
+
+    name = u'stream_filled_csv'
+
+    def __init__(self):
+        self.model_admin = None
+        self.upload = None
+
+    def setup(self, size, items):
+        self.model_admin = StudentAdmin(Student, admin.site)
+        rows = [[u'E-mail', u'Comment']] + [
+                [email, u'comment'] for email in get_uploaded_emails(items)]
+        self.upload = tempfile.NamedTemporaryFile(suffix='.csv')
+        for chunk in export.stream_rows(rows, export.CSVRowWriter()):
+            self.upload.write(chunk)
+        self.upload.flush()
+
+    def run(self):
+        upload = File(self.upload, os.path.basename(self.upload.name))
+        return consume(self.model_admin.stream_filled_csv(
+            Student, SHEET_MAPPING, fill.read_sheets(upload, u'Data')))
+
+    def teardown(self):
+        self.upload.close()
+
+
+class SendMassMailCase(Case):
+    """ Sending of plain text messages through locmem backend or local
+    SMTP server.
+    """
+
+    scale = 0.1
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = u'send_mass_mail[{0}]'.format(backend)
+        self.server = None
+        self.recipients = None
+        self.backend_args = None
+
+    def setup(self, size, items):
+        self.recipients = list(Student.objects.order_by('id').values_list(
+            'email', flat=True)[:items])
+        self.backend_args = {
+                'username': u'benchmarks@example.com',
+                'password': u'',
+                'use_tls': False,
+                'batch_pause': 0,
+                'retry_delay': 0,
+                }
+        if self.backend == u'smtp':
+            self.server = LocalSMTPServer()
+            self.backend_args.update({
+                'backend': 'django.core.mail.backends.smtp.EmailBackend',
+                'host': '127.0.0.1',
+                'port': self.server.start(),
+                })
+        else:
+            self.backend_args['backend'] = (
+                    'django.core.mail.backends.locmem.EmailBackend')
+
+    def run(self):
+        report = mail.send_mass_mail(
+                self.recipients, u'Benchmark', u'Message text.\n' * 20,
+                **self.backend_args)
+        django_mail.outbox = []
+        return report.bytes_sent
+
+    def teardown(self):
+        if self.server is not None:
+            self.server.stop()
+
+
+class RenderToPdfCase(Case):
+    """ Rendering of document, which has table with one row per item.
+    """
+
+    scale = 0.01
+
+    def __init__(self, use_cache):
+        self.use_cache = use_cache
+        self.name = u'render_to_pdf{0}'.format(
+                u'[cached]' if use_cache else u'')
+        self.context = None
+
+    def setup(self, size, items):
+        pdf.invalidate_pdf_cache()
+        self.context = {
+                'title': u'Students',
+                'date': datetime.date(2013, 1, 1),
+                'students': list(Student.objects.select_related(
+                    'school').order_by('id')[:items]),
+                }
+
+    def run(self):
+        return consume(pdf.render_to_pdf(
+            'benchmarks/document.html', self.context,
+            use_cache=self.use_cache))
+
+    def teardown(self):
+        pdf.invalidate_pdf_cache()
+
+
+def get_cases():
+    """ Returns list of all benchmark cases.
+    """
+    return [
+            DownloadSelectedCase(u'CSV', False),
+            DownloadSelectedCase(u'CSV', True),
+            DownloadSelectedCase(u'ODS', False),
+            DownloadSelectedCase(u'ODS', True),
+            DownloadSelectedCase(u'UTF16Tab', True),
+            DumpQueryToSheetCase(),
+            GenerateSpreadsheetCase(),
+            StreamFilledCSVCase(),
+            SendMassMailCase(u'locmem'),
+            SendMassMailCase(u'smtp'),
+            RenderToPdfCase(False),
+            RenderToPdfCase(True),
+            ]
@@ -0,0 +1,161 @@
+""" Measurement of benchmark cases.
+
+Each case is measured in forked process (if possible), so that peak
+resident set size of one case does not hide the peak of another.
+"""
+
+
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+from django.db import connection
+
+
+def read_status(field):
+    """ Returns value of memory field (in kilobytes) from
+    ``/proc/self/status`` or ``None``, if it is not available.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def get_rss():
+    """ Returns current resident set size in kilobytes or ``None``, if
+    it is not known.
+    """
+    return read_status('VmRSS')
+
+
+def reset_peak_rss():
+    """ Resets peak resident set size to the current one (Linux only),
+    so that forked process does not report peak of its parent.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def get_peak_rss():
+    """ Returns peak resident set size of process in kilobytes.
+    """
+    peak = read_status('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Mac OS X reports bytes.
+        peak //= 1024
+    return peak
+
+
+def percentile(values, fraction):
+    """ Returns percentile of values, interpolated linearly between the
+    closest ranks.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (
+            position - lower)
+
+
+def summarize(durations):
+    """ Returns latency statistics of durations in seconds.
+    """
+    return {
+            'min': min(durations),
+            'mean': sum(durations) / len(durations),
+            'p50': percentile(durations, 0.5),
+            'p90': percentile(durations, 0.9),
+            'p99': percentile(durations, 0.99),
+            'max': max(durations),
+            }
+
+
+def measure(case, size, repeat, warmup=1):
+    """ Runs case ``warmup + repeat`` times and returns dictionary with
+    results of the last ``repeat`` runs.
+    """
+    items = case.get_items(size)
+    case.setup(size, items)
+    try:
+        for i in range(warmup):
+            case.run()
+        gc.collect()
+        reset_peak_rss()
+        rss_start = get_rss()
+        durations = []
+        queries = []
+        output_size = None
+        for i in range(repeat):
+            gc.collect()
+            connection.use_debug_cursor = True
+            del connection.queries[:]
+            started = time.time()
+            output_size = case.run()
+            durations.append(time.time() - started)
+            queries.append(len(connection.queries))
+            connection.use_debug_cursor = None
+    finally:
+        case.teardown()
+    latency = summarize(durations)
+    items_per_second = None
+    if latency['p50']:
+        items_per_second = items / latency['p50']
+    peak_rss = get_peak_rss()
+    return {
+            'case': case.name,
+            'size': size,
+            'items': items,
+            'bytes': output_size,
+            'queries': max(queries),
+            'durations': durations,
+            'latency': latency,
+            'items_per_second': items_per_second,
+            'rss_start_kb': rss_start,
+            'peak_rss_kb': peak_rss,
+            'rss_growth_kb': (
+                peak_rss - rss_start if rss_start is not None else None),
+            }
+
+
+def measure_in_child(case, size, repeat, warmup=1):
+    """ Measures case in forked process. Falls back to measuring in
+    the current process, if ``fork`` is not available.
+    """
+    if not hasattr(os, 'fork'):
+        return measure(case, size, repeat, warmup)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = measure(case, size, repeat, warmup)
+        except BaseException:
+            result = {
+                    'case': case.name,
+                    'size': size,
+                    'error': traceback.format_exc(),
+                    }
+        with os.fdopen(write_fd, 'w') as output:
+            json.dump(result, output)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result_file:
+        data = result_file.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+
+""" Runs benchmarks and writes results as JSON.
+"""
+
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+
+BENCHMARKS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
+PROJECT_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+
+DEFAULT_SIZES = u'100,1000,10000'
+
+
+def parse_args(args):
+    """ Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+            '--sizes', default=DEFAULT_SIZES,
+            help=u'comma separated numbers of students in database '
+                 u'(default: %(default)s)')
+    parser.add_argument(
+            '--repeat', type=int, default=5,
+            help=u'measured runs of each case (default: %(default)s)')
+    parser.add_argument(
+            '--warmup', type=int, default=1,
+            help=u'not measured runs before measured ones '
+                 u'(default: %(default)s)')
+    parser.add_argument(
+            '--only', action='append', default=[],
+            help=u'run only cases, which names contain this string; '
+                 u'can be given several times')
+    parser.add_argument(
+            '--output', default=os.path.join('var', 'benchmarks.json'),
+            help=u'file, to which results are written '
+                 u'(default: %(default)s)')
+    parser.add_argument(
+            '--compare', metavar='FILE',
+            help=u'results of previous run, with which results are '
+                 u'compared')
+    return parser.parse_args(args)
+
+
+def setup_django():
+    """ Configures Django and creates database tables.
+    """
+    sys.path[:0] = [PROJECT_DIRECTORY, os.path.join(PROJECT_DIRECTORY, 'src')]
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def format_result(result):
+    """ Returns one line summary of case result.
+    """
+    if 'error' in result:
+        return u'{0[case]:<38} {0[size]:>7}  ERROR'.format(result)
+    return (
+            u'{0[case]:<38} {0[size]:>7} {0[items]:>7} items '
+            u'{1:>10.1f} items/s  p50 {0[latency][p50]:.4f} s  '
+            u'p90 {0[latency][p90]:.4f} s  {0[queries]:>5} queries  '
+            u'{0[peak_rss_kb]:>8} KB peak').format(
+                    result, result['items_per_second'] or 0)
+
+
+def compare_results(old, new):
+    """ Prints change of median latency of cases, which are in both
+    results.
+    """
+    previous = dict(
+            ((result['case'], result['size']), result)
+            for result in old['results'] if 'error' not in result)
+    print(u'\nChange of p50 latency:')
+    for result in new['results']:
+        old_result = previous.get((result['case'], result['size']))
+        if old_result is None or 'error' in result:
+            continue
+        old_p50 = old_result['latency']['p50']
+        new_p50 = result['latency']['p50']
+        change = (new_p50 - old_p50) / old_p50 * 100 if old_p50 else 0
+        print(u'{0:<38} {1:>7} {2:>10.4f} s -> {3:>10.4f} s {4:>+8.1f}%'
+              .format(result['case'], result['size'], old_p50, new_p50,
+                      change))
+
+
+def main(args):
+    """ Runs benchmarks.
+    """
+
+    options = parse_args(args)
+    setup_django()
+
+    import django
+    from benchmarks import cases
+    from benchmarks import measure
+    from benchmarks.benchapp.models import populate
+
+    sizes = [int(size) for size in options.sizes.split(u',')]
+    selected_cases = [
+            case for case in cases.get_cases()
+            if not options.only or any(
+                part in case.name for part in options.only)]
+
+    results = []
+    for size in sizes:
+        populate(size)
+        for case in selected_cases:
+            result = measure.measure_in_child(
+                    case, size, options.repeat, options.warmup)
+            results.append(result)
+            print(format_result(result))
+            if 'error' in result:
+                print(result['error'])
+
+    data = {
+            'created': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat,
+            'warmup': options.warmup,
+            'sizes': sizes,
+            'results': results,
+            }
+    output_directory = os.path.dirname(options.output)
+    if output_directory and not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    with open(options.output, 'w') as output:
+        json.dump(data, output, indent=2, sort_keys=True)
+    print(u'Results are written to {0}.'.format(options.output))
+
+    if options.compare:
+        with open(options.compare) as old_file:
+            compare_results(json.load(old_file), data)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,40 @@
+""" Django settings used by benchmarks.
+"""
+
+
+import os
+import tempfile
+
+
+BENCHMARKS_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
+
+DEBUG = False
+
+DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+            },
+        }
+
+INSTALLED_APPS = (
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'django.contrib.admin',
+        'nmadb_utils',
+        'benchmarks.benchapp',
+        )
+
+SECRET_KEY = 'benchmarks'
+
+TEMPLATE_DIRS = (
+        os.path.join(BENCHMARKS_DIRECTORY, 'templates'),
+        )
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+NMADB_PDF_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), 'nmadb-benchmarks-pdf-cache')
+NMADB_PDF_CACHE_SIZE = 100 * 1024 * 1024
+NMADB_EXPORT_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), 'nmadb-benchmarks-export-cache')
@@ -0,0 +1,46 @@
+""" Local SMTP server, which accepts and discards messages.
+"""
+
+
+import asyncore
+import smtpd
+import threading
+
+
+class DiscardingServer(smtpd.SMTPServer):
+    """ SMTP server, which only counts received messages.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+class LocalSMTPServer(object):
+    """ Runs :class:`DiscardingServer` in background thread.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """ Starts server and returns its port.
+        """
+        self.server = DiscardingServer()
+        self.thread = threading.Thread(
+                target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self.server.port
+
+    def stop(self):
+        """ Stops server.
+        """
+        self.server.close()
+        asyncore.close_all()
+        self.thread.join()
@@ -1,25 +1,55 @@
 #!/usr/bin/python
 
 
-from django.core.urlresolvers import reverse
+import collections
+
+from django.core.urlresolvers import reverse, get_resolver, get_urlconf
+from django.core.urlresolvers import get_script_prefix
 
 
 class Action(object):
     """ NMADB action.
     """
 
-    actions = []
+    # Registered actions by gid, in order of registration.
+    actions = collections.OrderedDict()
+    # Incremented, when actions are registered or unregistered.
+    version = 0
 
-    def __init__(self, gid, short_description, url_name):
+    def __init__(self, gid, short_description, url_name, app_label=None,
+                 permission=None):
+        """
+        :param app_label: label of application, under which action is
+            grouped.
+        :param permission: permission (``app_label.codename``), which
+            user must have to see action, or ``None``.
+        """
         self.gid = gid
         self.short_description = short_description
         self.url_name = url_name
+        self.app_label = app_label
+        self.permission = permission
+        self._url = None
+        self._url_key = None
 
     @property
     def url(self):
-        """ Returns url to action.
+        """ Returns url to action. Url is resolved once for each
+        URLconf (resolvers are recreated when URLconf is reloaded).
         """
-        return reverse(self.url_name)
+        urlconf = get_urlconf()
+        key = (get_resolver(urlconf), get_script_prefix())
+        if self._url_key is None or self._url_key[0] is not key[0] or (
+                self._url_key[1] != key[1]):
+            self._url = reverse(self.url_name, urlconf=urlconf)
+            self._url_key = key
+        return self._url
+
+    def is_available(self, user):
+        """ Checks if user can see action.
+        """
+        return self.permission is None or (
+                user is not None and user.has_perm(self.permission))
 
 
 class DuplicateGid(Exception):
@@ -27,19 +57,38 @@ class DuplicateGid(Exception):
     """
 
 
-def register(gid, short_description, url_name):
+def register(gid, short_description, url_name, app_label=None,
+             permission=None):
     """ Creates action and adds to list.
     """
-    for action in Action.actions:
-        if gid == action.gid:
-            raise DuplicateGid(u'gid: {0}'.format(gid))
-    Action.actions.append(Action(gid, short_description, url_name))
+    if gid in Action.actions:
+        raise DuplicateGid(u'gid: {0}'.format(gid))
+    Action.actions[gid] = Action(
+            gid, short_description, url_name, app_label, permission)
+    Action.version += 1
 
 
 def unregister(gid):
     """ Deletes action with specified gid.
     """
-    for i, action in enumerate(Action.actions):
-        if gid == action.gid:
-            del Action.actions[i]
-            return
+    if Action.actions.pop(gid, None) is not None:
+        Action.version += 1
+
+
+def get_actions(user=None):
+    """ Returns list of actions, which user can see. If user is not
+    given, then actions, which do not require permissions, are returned.
+    """
+    return [
+            action for action in Action.actions.itervalues()
+            if action.is_available(user)]
+
+
+def group_actions(actions):
+    """ Returns list of pairs ``(app_label, actions)``, ordered by the
+    first registered action of application.
+    """
+    groups = collections.OrderedDict()
+    for action in actions:
+        groups.setdefault(action.app_label, []).append(action)
+    return groups.items()
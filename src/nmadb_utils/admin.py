@@ -1,8 +1,19 @@
+import functools
+import itertools
+import os
+import tempfile
+
 from django.contrib import admin
-from django.shortcuts import render
+from django.contrib.admin import helpers
+from django.shortcuts import render, get_object_or_404
 from django import forms
 from django.utils.translation import ugettext as _
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.http import HttpResponseRedirect, Http404
+from django.core.servers.basehttp import FileWrapper
+from django.core.signing import BadSignature
+from django.core.urlresolvers import reverse
+from django.conf.urls import patterns, url
 from django.contrib.contenttypes.models import ContentType
 
 from pysheets.sheet import Sheet
@@ -12,64 +23,155 @@ from pysheets.writers import SheetWriter, SpreadSheetWriter
 from django_db_utils.forms import SpreadSheetField
 
 from nmadb_utils import models
+from nmadb_utils import export
+from nmadb_utils import fill
+from nmadb_utils import ods
+from nmadb_utils import selection as selection_token
+from nmadb_utils.export import get_field_value # pylint: disable=W0611
+
+
+def wrap_streaming_action(func):
+    """ Returns action, which remembers returned streaming response in
+    request.
+    """
+
+    @functools.wraps(func)
+    def wrapper(modeladmin, request, queryset):
+        response = func(modeladmin, request, queryset)
+        if isinstance(response, StreamingHttpResponse):
+            request.nmadb_streaming_response = response
+        return response
+
+    return wrapper
 
 
-def get_field_value(obj, parts):
-    """ Returns the value of the object field.
+class StreamingActionsMixin(object):
+    """ Allows actions to return :class:`StreamingHttpResponse`.
 
-    If it is callable, then returns its result.
+    ``ModelAdmin.response_action`` of Django 1.5 returns only instances
+    of :class:`HttpResponse` and redirects to changelist otherwise, so
+    without this mixin streamed downloads never reach the browser. Also
+    provides helpers, which serve generated files.
     """
-    value = obj
-    try:
-        for i, part in enumerate(parts):
-            value = getattr(value, part)
-            if hasattr(value, '__call__'):
-                value = value()
-            if hasattr(value, '__iter__'):
-                value = u'{{{0}}}'.format(u';'.join(
-                        get_field_value(obj, parts[i+1:])
-                        for obj in value
-                        ))
-                break
-        value = unicode(value)
-    except Exception as e:
-        value = _(u'Error: {0}').format(e)
-    return value
-
-
-class DownloadSelectedMixin(object):
+
+    def get_actions(self, request):
+        actions = super(StreamingActionsMixin, self).get_actions(request)
+        for name, (func, action, description) in actions.items():
+            actions[name] = (
+                    wrap_streaming_action(func), action, description)
+        return actions
+
+    def response_action(self, request, queryset):
+        response = super(StreamingActionsMixin, self).response_action(
+                request, queryset)
+        return getattr(request, 'nmadb_streaming_response', response)
+
+    def get_writer(self, writer_type):
+        """ Returns sheet or spreadsheet writer class.
+
+        :param writer_type: Sheet writer short name.
+        """
+        try:
+            return SheetWriter.plugins[writer_type]
+        except KeyError:
+            pass
+        try:
+            return SpreadSheetWriter.plugins[writer_type]
+        except KeyError:
+            return export.ROW_WRITERS[writer_type]
+
+    def download_file(self, data_file, writer_type):
+        """ Generates response, which serves already generated file.
+        """
+
+        writer = self.get_writer(writer_type)
+        response = StreamingHttpResponse(
+                FileWrapper(data_file), content_type=writer.mime_type)
+        response['Content-Length'] = os.fstat(data_file.fileno()).st_size
+        response['Content-Disposition'] = (
+                _(u'attachment; filename=data.{0}').format(
+                    writer.file_extensions[0]))
+        return response
+
+
+class SelectionTokenForm(forms.Form):
+    """ Form of intermediate action page, which passes selected objects
+    as signed token (see :mod:`nmadb_utils.selection`).
+    """
+    _selected_action = forms.CharField(widget=forms.HiddenInput)
+    # Makes admin to pass changelist queryset, which is filtered by
+    # token, instead of filtering it by ``_selected_action``.
+    select_across = forms.CharField(widget=forms.HiddenInput, initial=u'1')
+
+    def clean__selected_action(self):
+        """ Returns token data.
+        """
+        try:
+            return selection_token.load_token(
+                    self.cleaned_data['_selected_action'])
+        except BadSignature:
+            raise forms.ValidationError(_(u'Selection is not valid.'))
+
+    def get_queryset(self, request, queryset):
+        """ Returns objects selected for action.
+        """
+        try:
+            return selection_token.filter_queryset(
+                    request, queryset, self.cleaned_data['_selected_action'])
+        except ValueError:
+            raise Http404
+
+
+class DownloadSelectedMixin(StreamingActionsMixin):
     """ Download selected mixin for ModelAdmin.
     """
 
+    download_streaming = True
+    download_jobs = False
+    # If true, then generated files are cached in ``export.export_cache``
+    # and served again while queryset data is not changed. Modifications
+    # are noticed only through ``auto_now`` date fields, so models
+    # without them are cached only if ``NMADB_EXPORT_CACHE_MAX_AGE`` is
+    # set.
+    download_cache = False
+
+    # Number of worker processes used to format rows. If ``None``, then
+    # rows are formatted in the current process.
+    download_processes = None
+    # Minimum number of rows, for which rows are formatted in parallel.
+    download_parallel_min_rows = 10000
+
+    def iterate_rows(self, queryset, sheet_mapping):
+        """ Yields rows (lists of values) of queryset objects, described
+        by sheet mapping.
+        """
+
+        if (self.download_processes and self.download_processes > 1 and
+                queryset.count() >= self.download_parallel_min_rows):
+            return export.iterate_rows_parallel(
+                    queryset, sheet_mapping, self.download_processes)
+        mapping = export.compile_sheet_mapping(
+                queryset.model, sheet_mapping)
+        return mapping.iterate_rows(queryset)
+
     def dump_query_to_sheet(self, queryset, sheet_mapping, sheet=None):
         """ Dumps query to sheet.
         """
 
-        mapping = []
-        captions = []
-        related = set()
-        for caption, parts in sheet_mapping:
-            captions.append(caption)
-            mapping.append((caption, parts))
-            if len(parts) > 1:
-                related.add(u'__'.join(parts[:-1]))
+        captions = [caption for caption, parts in sheet_mapping]
 
         if sheet is None:
             sheet = Sheet()
         sheet.add_columns(captions)
 
-        for obj in queryset.select_related(*related):
-            info = {}
-            for caption, field in mapping:
-                info[caption] = unicode(get_field_value(obj, field))
-            sheet.append_dict(info)
+        for row in self.iterate_rows(queryset, sheet_mapping):
+            sheet.append_dict(dict(zip(captions, row)))
 
         return sheet
 
-    class DownloadSelectionForm(forms.Form):
+    class DownloadSelectionForm(SelectionTokenForm):
         """ Simple select field.
         """
-        _selected_action = forms.CharField(widget=forms.MultipleHiddenInput)
         selection = forms.ModelChoiceField(models.DownloadSelection.objects)
 
     def download_custom_selected(self, request, queryset):
@@ -81,23 +183,17 @@ class DownloadSelectedMixin(object):
             form = self.DownloadSelectionForm(request.POST)
 
             if form.is_valid():
+                queryset = form.get_queryset(request, queryset)
                 selection = form.cleaned_data['selection']
-                mapping = []
-                for row in selection.query.splitlines():
-                    parts = row.split(u':')
-                    field = parts[-1].strip()
-                    caption = u':'.join(parts[:-1])
-                    mapping.append((caption, field.split(u'__')))
-                return self.download_selected(
-                        queryset, selection.writer, mapping)
+                mapping = selection.get_sheet_mapping()
+                return self.download_or_schedule(
+                        request, queryset, selection.writer, mapping)
 
         if not form:
             form = self.DownloadSelectionForm(
                     initial={
-                        '_selected_action': [
-                            unicode(pk)
-                            for pk in queryset.values_list('id', flat=True)
-                            ]})
+                        '_selected_action': selection_token.make_token(
+                            request, queryset)})
 
         return render(
                 request,
@@ -105,23 +201,26 @@ class DownloadSelectedMixin(object):
                 {'form': form,})
     download_custom_selected.short_description = _(u'Download selected')
 
-    def download_selected(self, queryset, writer_type, sheet_mapping=None):
-        """ Generates sheet from queryset for downloading.
+    def get_sheet_mapping(self, sheet_mapping=None):
+        """ Returns sheet mapping, which should be used for download.
+        """
+        if sheet_mapping is not None:
+            return sheet_mapping
+        if hasattr(self, 'sheet_mapping'):
+            return self.sheet_mapping
+        return [
+                (column.replace(u'__', u':'), column.split(u'__'))
+                for column in self.list_display[1:]
+                ]
+
+    def dump_selected(self, queryset, writer_type, sheet_mapping):
+        """ Dumps queryset to sheet or spreadsheet, depending on writer
+        type.
 
         :param writer_type: Sheet writer short name.
+        :returns: pair ``(writer, data)``.
         """
 
-
-        if sheet_mapping is None:
-            if hasattr(self, 'sheet_mapping'):
-                sheet_mapping = self.sheet_mapping
-            else:
-                sheet_mapping = [
-                        (
-                            column.replace(u'__', u':'),
-                            column.split(u'__'))
-                        for column in self.list_display[1:]
-                        ]
         try:
             writer = SheetWriter.plugins[writer_type]
             data = self.dump_query_to_sheet(queryset, sheet_mapping)
@@ -130,175 +229,402 @@ class DownloadSelectedMixin(object):
             data = SpreadSheet()
             sheet = data.create_sheet(u'Duomenys')
             self.dump_query_to_sheet(queryset, sheet_mapping, sheet)
+        return writer, data
+
+    def is_streaming(self, writer_type):
+        """ Checks if file is written row by row. Writers, which are
+        not available as sheet writers, are always streaming.
+        """
+        if writer_type not in export.ROW_WRITERS and writer_type != u'ODS':
+            return False
+        return self.download_streaming or not (
+                writer_type in SheetWriter.plugins or
+                writer_type in SpreadSheetWriter.plugins)
+
+    def download_selected(self, queryset, writer_type, sheet_mapping=None):
+        """ Generates sheet from queryset for downloading.
+
+        :param writer_type: Sheet writer short name.
+        """
+
+        sheet_mapping = self.get_sheet_mapping(sheet_mapping)
+        streaming = self.is_streaming(writer_type)
+        cache_key = None
+        if self.download_cache:
+            cache_key = export.get_export_key(
+                    queryset, (writer_type, streaming), sheet_mapping)
+        if cache_key is not None:
+            cached = export.export_cache.open(cache_key)
+            if cached is not None:
+                return self.download_file(cached, writer_type)
+
+        if streaming and writer_type in export.ROW_WRITERS:
+            return self.stream_selected(
+                    queryset, writer_type, sheet_mapping, cache_key)
+        if streaming:
+            if cache_key is None:
+                result = tempfile.TemporaryFile()
+                self.write_selected_ods(result, queryset, sheet_mapping)
+                result.seek(0)
+                return self.download_file(result, writer_type)
+            entry = export.export_cache.create(cache_key)
+            try:
+                self.write_selected_ods(entry.file, queryset, sheet_mapping)
+            except Exception:
+                entry.discard()
+                raise
+            return self.download_file(
+                    entry.commit(reopen=True), writer_type)
+
+        writer, data = self.dump_selected(
+                queryset, writer_type, sheet_mapping)
 
         response = HttpResponse(content_type=writer.mime_type)
         response['Content-Disposition'] = (
                 _(u'attachment; filename=data.{0}').format(
                     writer.file_extensions[0]))
         data.write(response, writer=writer())
+        if cache_key is not None:
+            entry = export.export_cache.create(cache_key)
+            entry.write(response.content)
+            entry.commit()
         return response
 
+    def encode_selected(self, queryset, writer_type, sheet_mapping):
+        """ Yields encoded chunks of sheet, generated from queryset.
+
+        :param writer_type: Row writer short name.
+        """
+
+        writer = export.ROW_WRITERS[writer_type]()
+        captions = [caption for caption, parts in sheet_mapping]
+        rows = itertools.chain(
+                [captions], self.iterate_rows(queryset, sheet_mapping))
+        return export.stream_rows(rows, writer)
+
+    def stream_selected(self, queryset, writer_type, sheet_mapping,
+                        cache_key=None):
+        """ Generates streaming response, which encodes queryset rows
+        one by one, without building sheet in memory.
+
+        :param writer_type: Row writer short name.
+        :param cache_key: if given, then streamed file is stored in
+            export cache under this key.
+        """
+
+        writer = export.ROW_WRITERS[writer_type]
+        chunks = self.encode_selected(queryset, writer_type, sheet_mapping)
+        if cache_key is not None:
+            chunks = export.export_cache.tee(cache_key, chunks)
+        response = StreamingHttpResponse(
+                chunks, content_type=writer.mime_type)
+        response['Content-Disposition'] = (
+                _(u'attachment; filename=data.{0}').format(
+                    writer.file_extensions[0]))
+        return response
+
+    def write_selected_ods(self, output, queryset, sheet_mapping):
+        """ Writes ODS spreadsheet generated from queryset into seekable
+        file-like object, row by row.
+        """
+
+        captions = [caption for caption, parts in sheet_mapping]
+        writer = ods.ODSWriter()
+        try:
+            writer.write_sheet(u'Duomenys', itertools.chain(
+                [captions], self.iterate_rows(queryset, sheet_mapping)))
+            writer.save(output)
+        finally:
+            writer.close()
+
+    def write_selected(self, output, queryset, writer_type,
+                       sheet_mapping=None):
+        """ Writes sheet generated from queryset into file-like object.
+
+        :param writer_type: Sheet writer short name.
+        :returns: writer class, which was used.
+        """
+
+        sheet_mapping = self.get_sheet_mapping(sheet_mapping)
+        if writer_type in export.ROW_WRITERS:
+            for chunk in self.encode_selected(
+                    queryset, writer_type, sheet_mapping):
+                output.write(chunk)
+            return export.ROW_WRITERS[writer_type]
+        if self.is_streaming(writer_type):
+            self.write_selected_ods(output, queryset, sheet_mapping)
+            return ods.ODSWriter
+
+        writer, data = self.dump_selected(
+                queryset, writer_type, sheet_mapping)
+        data.write(output, writer=writer())
+        return writer
+
+    def schedule_selected(self, request, queryset, writer_type,
+                          sheet_mapping=None):
+        """ Creates background export job and redirects to its status
+        page.
+        """
+
+        job = models.ExportJob.create(
+                queryset, writer_type, self.get_sheet_mapping(sheet_mapping),
+                user=request.user)
+        self.message_user(
+                request,
+                _(u'Export was scheduled. The file will be available in '
+                  u'the job page, when it is generated.'))
+        return HttpResponseRedirect(reverse(
+            '{0}:nmadb_utils_exportjob_change'.format(self.admin_site.name),
+            args=(job.pk,)))
+
+    def download_or_schedule(self, request, queryset, writer_type,
+                             sheet_mapping=None):
+        """ Downloads selected objects or, if background jobs are
+        enabled with ``download_jobs``, schedules export job.
+        """
+
+        if self.download_jobs:
+            return self.schedule_selected(
+                    request, queryset, writer_type, sheet_mapping)
+        return self.download_selected(queryset, writer_type, sheet_mapping)
+
     def download_selected_as_csv(self, request, queryset):
         """ Generates CSV from queryset for download.
         """
-        return self.download_selected(queryset, u'CSV')
+        return self.download_or_schedule(request, queryset, u'CSV')
     download_selected_as_csv.short_description = _(u'Download as CSV.')
 
     def download_selected_as_ods(self, request, queryset):
         """ Generates ODS from queryset for download.
         """
-        return self.download_selected(queryset, u'ODS')
+        return self.download_or_schedule(request, queryset, u'ODS')
     download_selected_as_ods.short_description = _(u'Download as ODS.')
 
     def download_selected_as_UTF16Tab_csv(self, request, queryset):
-        """ Generates CSV from queryset for download.
+        """ Generates tab separated UTF-16 CSV from queryset for
+        download.
         """
-        writer = SheetWriter.plugins[u'CSV']
-        data = utils.dump_query_to_sheet(queryset)
-
-        response = HttpResponse(content_type=writer.mime_type)
-        response['Content-Disposition'] = (
-                _('attachment; filename=data.csv'))
-        data.write(
-                response,
-                writer=writer(quotechar='\t', encoding='utf-16'),)
-        return response
+        return self.download_or_schedule(request, queryset, u'UTF16Tab')
     download_selected_as_UTF16Tab_csv.short_description = (
             _(u'Download as UTF16 CSV.'))
 
 
 class AllObjectsActionMixin(object):
-    """ Perform action on all objects without selecting them.
-
-    .. todo::
-        Make to work.
+    """ Allows to perform actions, listed in ``actions_without_selection``,
+    on all objects of changelist (with applied filters) without selecting
+    them.
     """
 
-    def response_action(self, request, queryset):
+    actions_without_selection = ()
+
+    def changelist_view(self, request, extra_context=None):
         """ Overriding to allow calling without selecting any objects.
 
-        Based on `answer on StackOverflow
-        <http://stackoverflow.com/questions/4500924/django-admin-action-without-selecting-objects>`_.
+        Admin calls action only if some objects are selected, therefore
+        empty selection is replaced with "all objects" selection, the same
+        as made by "Select all" link of changelist.
         """
-        selected = request.POST.getlist(admin.ACTION_CHECKBOX_NAME)
-        data = request.POST.copy()
-        print 'Veikia 1'
-        if (data['action'] in self.actions_without_selection):
-            print 'Veikia 2'
-            if len(selected) == 0:
-                print 'Veikia 3'
-                ct = ContentType.objects.get_for_model(queryset.model)
-                klass = ct.model_class()
-                queryset = klass.objects.all()
-                return getattr(self, data['action'])(request, queryset)
-            else:
-                print 'Veikia 4'
-                msg = _(u'For this action no items must be selected. '
-                        u'No items have been changed.')
-                self.message_user(request, msg)
-                return None
-        else:
-            print 'Veikia 5'
-            return super(AllObjectsActionMixin, self).response_action(
-                    request, queryset)
-
-
-class FillMisingMixin(object):
+        if request.method == 'POST' and 'index' in request.POST:
+            try:
+                action = request.POST.getlist('action')[
+                        int(request.POST['index'])]
+            except (ValueError, IndexError):
+                action = None
+            if action in self.actions_without_selection:
+                if request.POST.getlist(helpers.ACTION_CHECKBOX_NAME):
+                    self.message_user(
+                            request,
+                            _(u'For this action no items must be selected. '
+                              u'No items have been changed.'))
+                    return HttpResponseRedirect(request.get_full_path())
+                data = request.POST.copy()
+                data.setlist(helpers.ACTION_CHECKBOX_NAME, [u'0'])
+                data['select_across'] = u'1'
+                request.POST = data
+        return super(AllObjectsActionMixin, self).changelist_view(
+                request, extra_context)
+
+
+class FillMisingMixin(StreamingActionsMixin):
     """ Fill missing data in sheet from database mixin for ModelAdmin.
     """
 
+    # If true, then uploaded file is read row by row instead of parsing
+    # it into memory. Filled CSV file is streamed while it is generated,
+    # and filled ODS file is written row by row into temporary file.
+    fill_missing_streaming = True
+
     def generate_spreadsheet(self, klass, sheet_mapping, data):
         """ Generates spreadsheet.
         """
 
-        mapping = []
+        spreadsheet = SpreadSheet()
+        for name, rows in self.iterate_filled_sheets(
+                klass, sheet_mapping, data):
+            new_sheet = spreadsheet.create_sheet(name, captions=next(rows))
+            for row in rows:
+                new_sheet.append_iterable(row)
+        return spreadsheet
+
+    def stream_filled_csv(self, klass, sheet_mapping, data):
+        """ Generates streaming response, which encodes filled rows
+        as CSV one by one.
+        """
+
+        writer = export.ROW_WRITERS[u'CSV']
+        rows = itertools.chain.from_iterable(
+                rows for name, rows in self.iterate_filled_sheets(
+                    klass, sheet_mapping, data))
+        response = StreamingHttpResponse(
+                export.stream_rows(rows, writer()),
+                content_type=writer.mime_type)
+        response['Content-Disposition'] = (
+                _(u'attachment; filename=data.{0}').format(
+                    writer.file_extensions[0]))
+        return response
+
+    def write_filled_ods(self, output, klass, sheet_mapping, data):
+        """ Writes filled spreadsheet as ODS into seekable file-like
+        object, row by row.
+        """
+
+        writer = ods.ODSWriter()
+        try:
+            for name, rows in self.iterate_filled_sheets(
+                    klass, sheet_mapping, data):
+                writer.write_sheet(name, rows)
+            writer.save(output)
+        finally:
+            writer.close()
+
+    def iterate_filled_sheets(self, klass, sheet_mapping, data):
+        """ Yields pairs ``(sheet_name, rows)`` for each sheet of data,
+        where rows is iterator of lists of values (the first one is
+        captions). Rows have to be consumed before the next sheet.
+        """
+
         mapping_dict = {}
         captions = []
-        related = set()
         for caption, parts in sheet_mapping:
             captions.append(caption)
-            mapping.append((caption, parts))
             mapping_dict[caption] = parts
-            if len(parts) > 1:
-                related.add(u'__'.join(parts[:-1]))
 
-        spreadsheet = SpreadSheet()
-        make_provided = lambda x: x + u' (provided)'
+        compiled = export.compile_sheet_mapping(klass, sheet_mapping)
+
         for sheet in data:
-            keys = set(sheet.captions) & set(captions)
-            provided_captions = [
-                    make_provided(caption) for caption in sheet.captions]
-            new_sheet = spreadsheet.create_sheet(
-                    sheet.name,
-                    captions=provided_captions + captions)
-            fill_columns = len(captions)
-            for row in sheet:
-                query = dict(
+            yield sheet.name, self.iterate_filled_rows(
+                    klass, compiled, mapping_dict, captions, sheet)
+
+    def iterate_filled_rows(self, klass, compiled, mapping_dict, captions,
+                            sheet):
+        """ Yields captions and rows of sheet, filled with data found
+        in database.
+        """
+
+        make_provided = lambda x: x + u' (provided)'
+        keys = set(sheet.captions) & set(captions)
+        provided_captions = [
+                make_provided(caption) for caption in sheet.captions]
+        yield provided_captions + captions
+        fill_columns = len(captions)
+        resolver = fill.KeyResolver(
+                klass, compiled,
+                [u'__'.join(mapping_dict[key]) for key in keys])
+        if getattr(sheet, 'streaming', False):
+            # Rows of streamed sheet can be read only once, so they are
+            # always resolved in batches.
+            scan = False
+        else:
+            scan = resolver.should_scan(sum(1 for row in sheet))
+        if scan:
+            sheet_batches = [list(sheet)]
+        else:
+            sheet_batches = fill.batches(sheet, fill.FILL_BATCH_SIZE)
+        for rows in sheet_batches:
+            queries = [
+                    dict(
                         (u'__'.join(mapping_dict[key]), row[key])
                         for key in keys
                         )
-                try:
-                    obj = klass.objects.get(**query)
-                except Exception as e:
-                    new_sheet.append_iterable(
-                            list(row) +
-                            [_(u'Error: {0}').format(e)] * fill_columns)
+                    for row in rows]
+            results = resolver.resolve(queries, scan=scan)
+            for row, (values, error) in zip(rows, results):
+                provided = [row[key] for key in sheet.captions]
+                if error is not None:
+                    yield provided + (
+                            [_(u'Error: {0}').format(error)] *
+                            fill_columns)
                 else:
-                    info = dict(
-                            (make_provided(key), row[key])
-                            for key in row.keys())
-                    for caption, field in mapping:
-                        info[caption] = unicode(
-                                get_field_value(obj, field))
-                    new_sheet.append_dict(info)
-        return spreadsheet
+                    yield provided + list(values)
 
-    class FillMissingForm(forms.Form):
+    class FillMissingForm(SelectionTokenForm):
         """ Simple select field.
         """
-        _selected_action = forms.CharField(widget=forms.MultipleHiddenInput)
         selection = forms.ModelChoiceField(models.DownloadSelection.objects)
         spreadsheet = SpreadSheetField(sheet_name=_(u'Data'))
 
+    class StreamingFillMissingForm(FillMissingForm):
+        """ Form, which leaves uploaded file unparsed, so that it can
+        be read row by row.
+        """
+        spreadsheet = forms.FileField()
+
+        def clean_spreadsheet(self):
+            """ Checks if file type is supported and file can be read,
+            because errors cannot be reported after streaming response
+            is started.
+            """
+            data = self.cleaned_data['spreadsheet']
+            extension = fill.get_file_extension(data.name)
+            if extension not in fill.READ_EXTENSIONS:
+                raise forms.ValidationError(
+                        _(u'Only CSV and ODS files are supported.'))
+            if extension == u'ods' and not ods.is_spreadsheet(data):
+                raise forms.ValidationError(
+                        _(u'File is not valid ODS spreadsheet.'))
+            if extension == u'csv' and not fill.is_csv_readable(data):
+                raise forms.ValidationError(
+                        _(u'CSV file has to be encoded in UTF-8 or '
+                          u'UTF-16.'))
+            return data
+
     def fill_missing(self, request, queryset):
         """ Allows to download sheet filled with missing data from
         database.
 
         Settings are stored in database.
         """
+        if self.fill_missing_streaming:
+            form_class = self.StreamingFillMissingForm
+        else:
+            form_class = self.FillMissingForm
         form = None
         if 'apply' in request.POST:
-            form = self.FillMissingForm(request.POST, request.FILES)
+            form = form_class(request.POST, request.FILES)
 
             if form.is_valid():
+                queryset = form.get_queryset(request, queryset)
                 selection = form.cleaned_data['selection']
-                mapping = []
-                for row in selection.query.splitlines():
-                    parts = row.split(u':')
-                    field = parts[-1].strip()
-                    caption = u':'.join(parts[:-1])
-                    mapping.append((caption, field.split(u'__')))
+                mapping = selection.get_sheet_mapping()
 
                 data = form.cleaned_data['spreadsheet']
                 ct = ContentType.objects.get_for_model(queryset.model)
                 klass = ct.model_class()
-                spreadsheet = self.generate_spreadsheet(
-                        klass,
-                        mapping,
-                        data,
-                        )
-                writer = SpreadSheetWriter.plugins[u'ODS']
-                response = HttpResponse(content_type=writer.mime_type)
-                response['Content-Disposition'] = (
-                        _(u'attachment; filename=data.{0}').format(
-                            writer.file_extensions[0]))
-                spreadsheet.write(response, writer=writer())
-                return response
+                if self.fill_missing_streaming:
+                    sheets = fill.read_sheets(data, _(u'Data'))
+                    if fill.get_file_extension(data.name) == u'csv':
+                        return self.stream_filled_csv(klass, mapping, sheets)
+                    data = sheets
+                result = tempfile.TemporaryFile()
+                self.write_filled_ods(result, klass, mapping, data)
+                result.seek(0)
+                return self.download_file(result, u'ODS')
 
         if not form:
-            form = self.FillMissingForm(
-                    initial={'_selected_action': request.POST.getlist(
-                        admin.ACTION_CHECKBOX_NAME)})
+            form = form_class(
+                    initial={
+                        '_selected_action': selection_token.make_token(
+                            request, queryset)})
 
         return render(
                 request,
@@ -347,3 +673,97 @@ class DownloadSelectionAdmin(ModelAdmin):
 
 
 admin.site.register(models.DownloadSelection, DownloadSelectionAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    """ Administration for ExportJob: job status page with download
+    link.
+    """
+
+    list_display = (
+            'id',
+            'model',
+            'writer',
+            'status',
+            'user',
+            'created',
+            'finished',
+            'download_link',
+            )
+
+    list_filter = (
+            'status',
+            'writer',
+            )
+
+    readonly_fields = (
+            'model',
+            'writer',
+            'sheet_mapping',
+            'status',
+            'user',
+            'created',
+            'started',
+            'finished',
+            'download_link',
+            'error',
+            )
+
+    fields = readonly_fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def queryset(self, request):
+        """ Returns all jobs for superusers and own jobs for other
+        users.
+        """
+        queryset = super(ExportJobAdmin, self).queryset(request)
+        if request.user.is_superuser:
+            return queryset
+        return queryset.filter(user=request.user)
+
+    def download_link(self, obj):
+        """ Returns link to generated file.
+        """
+        if obj.status != models.ExportJob.DONE:
+            return u''
+        return u'<a href="{0}">{1}</a>'.format(
+                reverse(
+                    '{0}:nmadb_utils_exportjob_download'.format(
+                        self.admin_site.name),
+                    args=(obj.pk,)),
+                _(u'Download'))
+    download_link.allow_tags = True
+    download_link.short_description = _(u'file')
+
+    def get_urls(self):
+        urls = super(ExportJobAdmin, self).get_urls()
+        return patterns(
+                '',
+                url(r'^(\d+)/download/$',
+                    self.admin_site.admin_view(self.download_view),
+                    name='nmadb_utils_exportjob_download'),
+                ) + urls
+
+    def download_view(self, request, object_id):
+        """ Sends generated file.
+        """
+        job = get_object_or_404(
+                models.ExportJob, pk=object_id, status=models.ExportJob.DONE)
+        if not (request.user.is_superuser or request.user == job.user):
+            raise Http404
+        try:
+            data = open(job.get_file_path(), 'rb')
+        except IOError:
+            raise Http404
+        response = StreamingHttpResponse(
+                FileWrapper(data), content_type=job.content_type)
+        response['Content-Disposition'] = (
+                _(u'attachment; filename=data.{0}').format(
+                    os.path.splitext(job.file_name)[1][1:]))
+        response['Content-Length'] = os.fstat(data.fileno()).st_size
+        return response
+
+
+admin.site.register(models.ExportJob, ExportJobAdmin)
@@ -0,0 +1,199 @@
+""" Size bounded cache of generated files on local disk.
+
+Entries are evicted in least recently used order: the access time of
+the entry file is updated on each hit, while its modification time
+keeps the time when entry was stored.
+"""
+
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def make_key(*parts):
+    """ Returns hexadecimal key, computed from ``repr`` of parts.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class CacheEntry(object):
+    """ File, which is stored into cache when it is committed.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        if not os.path.isdir(cache.directory):
+            os.makedirs(cache.directory)
+        fd, self.temp_path = tempfile.mkstemp(
+                dir=cache.directory, suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        """ Writes data into entry.
+        """
+        self.file.write(data)
+
+    def commit(self, reopen=False):
+        """ Stores written data into cache.
+
+        :param reopen: if true, then file opened for reading is
+            returned. It is opened before eviction, so it stays
+            readable even if entry is evicted immediately (for example,
+            when it is larger than the whole cache).
+        """
+        self.file.close()
+        data = open(self.temp_path, 'rb') if reopen else None
+        os.rename(self.temp_path, self.cache.get_path(self.key))
+        self.cache.evict()
+        return data
+
+    def discard(self):
+        """ Removes written data.
+        """
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class DiskCache(object):
+    """ Cache of files in directory, which total size is at most
+    ``max_size`` bytes.
+    """
+
+    def __init__(self, directory, max_size, max_age=None):
+        """
+        :param max_age: if given, then entries older than ``max_age``
+            seconds are not used.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_path(self, key):
+        """ Returns path of file, in which entry is stored.
+        """
+        return os.path.join(self.directory, key)
+
+    def open(self, key):
+        """ Returns opened entry file or ``None``, if entry is not in
+        cache.
+        """
+        path = self.get_path(key)
+        try:
+            stat = os.stat(path)
+            if (self.max_age is not None and
+                    time.time() - stat.st_mtime > self.max_age):
+                os.remove(path)
+                raise OSError(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+            entry = open(path, 'rb')
+        except (IOError, OSError):
+            self.misses += 1
+            log.debug(u'Cache %s miss: %s.', self.directory, key)
+            return None
+        self.hits += 1
+        log.debug(u'Cache %s hit: %s.', self.directory, key)
+        return entry
+
+    def create(self, key):
+        """ Returns :class:`CacheEntry`, which has to be committed to
+        be stored under key.
+        """
+        return CacheEntry(self, key)
+
+    def tee(self, key, chunks):
+        """ Yields chunks and stores them under key after the last
+        chunk was yielded. If iteration is interrupted, nothing is
+        stored.
+        """
+        entry = self.create(key)
+        try:
+            for chunk in chunks:
+                entry.write(chunk)
+                yield chunk
+        except BaseException:
+            entry.discard()
+            raise
+        entry.commit()
+
+    def delete(self, key):
+        """ Removes entry from cache.
+        """
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def list_entries(self):
+        """ Returns list of ``(access_time, size, path)`` of stored
+        entries.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith('.part'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Removes least recently used entries, until cache fits into
+        ``max_size``.
+        """
+        entries = self.list_entries()
+        size = sum(entry[1] for entry in entries)
+        for access_time, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+            log.info(u'Cache %s evicted: %s.', self.directory, path)
+
+    def clear(self, prefix=''):
+        """ Removes all entries, which keys start with prefix.
+        """
+        for access_time, size, path in self.list_entries():
+            if not os.path.basename(path).startswith(prefix):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_stats(self):
+        """ Returns dictionary with cache statistics of this process.
+        """
+        entries = self.list_entries()
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'size': sum(entry[1] for entry in entries),
+                }
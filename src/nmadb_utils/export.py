@@ -0,0 +1,910 @@
+""" Helpers for exporting querysets row by row.
+"""
+
+
+import codecs
+import csv
+import inspect
+import multiprocessing
+import operator
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import connections
+from django.db import models
+from django.db.models import Count, Max, Q
+from django.db.models.sql.datastructures import EmptyResultSet
+try:
+    from django.db.models import Prefetch
+except ImportError:
+    Prefetch = None
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.translation import ugettext as _
+
+from nmadb_utils import cache
+
+
+# Chunks are also used in ``pk__in`` lists, which in SQLite may have at
+# most 999 items.
+EXPORT_CHUNK_SIZE = getattr(settings, 'NMADB_EXPORT_CHUNK_SIZE', 500)
+
+# Number of rows formatted by one worker process task in parallel
+# export.
+EXPORT_SHARD_SIZE = getattr(settings, 'NMADB_EXPORT_SHARD_SIZE', 5000)
+
+# Cache of generated export files, used by admins with enabled
+# ``download_cache``.
+EXPORT_CACHE_DIR = getattr(
+        settings, 'NMADB_EXPORT_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'nmadb-export-cache'))
+EXPORT_CACHE_SIZE = getattr(
+        settings, 'NMADB_EXPORT_CACHE_SIZE', 100 * 1024 * 1024)
+EXPORT_CACHE_MAX_AGE = getattr(settings, 'NMADB_EXPORT_CACHE_MAX_AGE', None)
+
+export_cache = cache.DiskCache(
+        EXPORT_CACHE_DIR, EXPORT_CACHE_SIZE, EXPORT_CACHE_MAX_AGE)
+
+
+ATTRIBUTE = 'attribute'
+METHOD = 'method'
+MANAGER = 'manager'
+DYNAMIC = 'dynamic'
+
+
+def walk_field_value(value, parts):
+    """ Returns the value of the object field, found by probing each
+    part: callable values are called and iterable ones are joined.
+
+    Raises exception if part is missing.
+    """
+    for i, part in enumerate(parts):
+        value = getattr(value, part)
+        if hasattr(value, '__call__'):
+            value = value()
+        if hasattr(value, '__iter__'):
+            return u'{{{0}}}'.format(u';'.join(
+                    get_field_value(obj, parts[i+1:])
+                    for obj in value
+                    ))
+    return unicode(value)
+
+
+def get_field_value(obj, parts):
+    """ Returns the value of the object field.
+
+    If it is callable, then returns its result.
+    """
+    try:
+        return walk_field_value(obj, parts)
+    except Exception as e:
+        return _(u'Error: {0}').format(e)
+
+
+def parse_sheet_mapping(text):
+    """ Parses sheet mapping, which is written one column per line in
+    form ``column caption: field__name``. Blank lines are skipped.
+    """
+    mapping = []
+    for row in text.splitlines():
+        if not row.strip():
+            continue
+        parts = row.split(u':')
+        field = parts[-1].strip()
+        caption = u':'.join(parts[:-1])
+        mapping.append((caption, field.split(u'__')))
+    return mapping
+
+
+def format_sheet_mapping(sheet_mapping):
+    """ Formats sheet mapping, so that it can be parsed by
+    :func:`parse_sheet_mapping`.
+    """
+    return u'\n'.join(
+            u'{0}: {1}'.format(caption, u'__'.join(parts))
+            for caption, parts in sheet_mapping)
+
+
+def is_plain_field(field):
+    """ Checks if field is a built-in field, which value is stored in
+    one column and is not iterable.
+    """
+    return (
+            type(field).__module__.startswith('django.db.models') and
+            not isinstance(field, models.FileField))
+
+
+def get_related_accessors(model):
+    """ Returns dictionary, which maps reverse relation accessor names
+    of the model to tuples ``(kind, related_model, related_field)``.
+    """
+    opts = model._meta
+    accessors = {}
+    for related in opts.get_all_related_objects():
+        if related.field.unique:
+            kind = ATTRIBUTE
+        else:
+            kind = MANAGER
+        accessors[related.get_accessor_name()] = (
+                kind, related.model, related.field)
+    for related in opts.get_all_related_many_to_many_objects():
+        accessors[related.get_accessor_name()] = (
+                MANAGER, related.model, related.field)
+    return accessors
+
+
+def resolve_part(model, part):
+    """ Returns ``(kind, next_model, field)`` of model attribute.
+
+    ``next_model`` is the model of the attribute value (or its items)
+    if it is a relation, ``field`` is the field object if the
+    attribute is a field of the model or the field of related model,
+    which points back, if it is a reverse relation.
+    """
+    try:
+        field, _model, direct, m2m = model._meta.get_field_by_name(part)
+    except FieldDoesNotExist:
+        pass
+    else:
+        if direct and m2m:
+            return MANAGER, field.rel.to, field
+        if direct:
+            if field.rel:
+                return ATTRIBUTE, field.rel.to, field
+            if is_plain_field(field):
+                return ATTRIBUTE, None, field
+            return DYNAMIC, None, field
+    try:
+        return get_related_accessors(model)[part]
+    except KeyError:
+        pass
+    if inspect.ismethod(getattr(model, part, None)):
+        return METHOD, None, None
+    return DYNAMIC, None, None
+
+
+def validate_field_path(model, parts):
+    """ Checks if field path can be read from objects of model.
+
+    Path is checked only until the first method or attribute, which
+    type is unknown.
+
+    :returns: error message or ``None``.
+    """
+    if not parts or not all(parts):
+        return _(u'Field name is empty.')
+    i = 0
+    while i < len(parts):
+        part = parts[i]
+        kind, next_model, field = resolve_part(model, part)
+        if kind == DYNAMIC and field is None and not (
+                hasattr(model, part) or
+                part in [f.attname for f in model._meta.fields]):
+            return _(u'{0} has no attribute {1}.').format(
+                    model._meta.object_name, part)
+        if kind == MANAGER and parts[i + 1:i + 2] == [u'all']:
+            i += 1
+        if next_model is None:
+            return None
+        model = next_model
+        i += 1
+    return None
+
+
+class FieldPath(object):
+    """ Accessor for ``__`` separated field path, compiled from model
+    meta information.
+
+    Leading field and foreign key hops are read with one
+    ``attrgetter``; the rest of path is handled by tail, which is one
+    of:
+
+    +   ``None`` - the value is converted to unicode;
+    +   ``MANAGER`` - related objects are iterated and formatted with
+        sub-path compiled for related model;
+    +   ``METHOD`` or ``DYNAMIC`` - the rest of path is walked by
+        probing values as :func:`get_field_value` does.
+    """
+
+    def __init__(self, model, parts):
+        self.model = model
+        self.parts = list(parts)
+        self.hops = []
+        self.tail = None
+        self.tail_name = None
+        self.tail_parts = []
+        self.sub_path = None
+
+        attributes = []
+        i = 0
+        while i < len(self.parts):
+            part = self.parts[i]
+            if model is None:
+                kind, next_model, field = DYNAMIC, None, None
+            else:
+                kind, next_model, field = resolve_part(model, part)
+            if kind == ATTRIBUTE and (
+                    next_model is not None or i == len(self.parts) - 1):
+                self.hops.append((ATTRIBUTE, part, next_model, field))
+                attributes.append(part)
+                model = next_model
+                i += 1
+                continue
+            if kind == MANAGER and i + 1 < len(self.parts):
+                rest = self.parts[i + 1:]
+                if rest[0] == u'all':
+                    rest = rest[1:]
+                    self.tail = MANAGER
+                elif resolve_part(next_model, rest[0])[0] != DYNAMIC:
+                    self.tail = MANAGER
+                if self.tail == MANAGER:
+                    self.hops.append((MANAGER, part, next_model, field))
+                    self.tail_name = part
+                    self.sub_path = FieldPath(next_model, rest)
+                    break
+            if kind == METHOD:
+                self.hops.append((METHOD, part, None, None))
+                self.tail = METHOD
+            else:
+                self.hops.append((DYNAMIC, part, None, field))
+                self.tail = DYNAMIC
+            self.tail_parts = self.parts[i:]
+            break
+
+        if attributes:
+            self.getter = operator.attrgetter('.'.join(attributes))
+        else:
+            self.getter = None
+
+    def get_select_related(self):
+        """ Returns lookup of the leading foreign key hops or ``None``.
+        """
+        prefix = []
+        for kind, part, next_model, field in self.hops:
+            if kind != ATTRIBUTE or next_model is None:
+                break
+            prefix.append(part)
+        if prefix:
+            return u'__'.join(prefix)
+        else:
+            return None
+
+    def get_prefetch_related(self):
+        """ Returns list of tuples ``(lookup, hop, sub_path)`` of
+        related managers, which are iterated by this path.
+
+        ``hop`` and ``sub_path`` are ``None`` for foreign key chains
+        after related manager.
+        """
+        prefix = []
+        for hop in self.hops:
+            kind, part, next_model, field = hop
+            if kind == ATTRIBUTE and next_model is not None:
+                prefix.append(part)
+            elif kind == MANAGER:
+                lookup = u'__'.join(prefix + [part])
+                lookups = [(lookup, hop, self.sub_path)]
+                select_related = self.sub_path.get_select_related()
+                if select_related:
+                    lookups.append((
+                        lookup + u'__' + select_related, None, None))
+                for sub_lookup, sub_hop, sub_path in (
+                        self.sub_path.get_prefetch_related()):
+                    lookups.append((
+                        lookup + u'__' + sub_lookup, sub_hop, sub_path))
+                return lookups
+            else:
+                break
+        return []
+
+    def get_column_lookup(self):
+        """ Returns lookup for ``values_list`` if path reads database
+        column through not null foreign keys, ``None`` otherwise.
+
+        Values of such paths read from objects and from
+        ``values_list`` are the same.
+        """
+        if self.tail is not None or not self.hops:
+            return None
+        model = self.model
+        for kind, part, next_model, field in self.hops[:-1]:
+            if field is None or field.null or field not in (
+                    model._meta.fields):
+                return None
+            model = next_model
+        kind, part, next_model, field = self.hops[-1]
+        if next_model is not None:
+            return None
+        return u'__'.join(self.parts)
+
+    def get_needed_fields(self):
+        """ Returns set of names of model fields, which are needed by
+        this path, ``None`` if unknown.
+        """
+        kind, part, next_model, field = self.hops[0]
+        if kind == ATTRIBUTE:
+            if field is not None and field in self.model._meta.fields:
+                if len(self.hops) > 1 and self.hops[1][0] not in (
+                        ATTRIBUTE, MANAGER):
+                    return None
+                return set([field.name])
+            return set()
+        if kind == MANAGER:
+            return set()
+        return None
+
+    def get_plain_field(self):
+        """ Returns the field if path is one hop to plain field,
+        ``None`` otherwise.
+        """
+        if self.tail is None and len(self.hops) == 1:
+            kind, part, next_model, field = self.hops[0]
+            if next_model is None:
+                return field
+        return None
+
+    def __call__(self, obj):
+        """ Returns the value of the object field.
+        """
+        try:
+            if self.getter is not None:
+                obj = self.getter(obj)
+            if self.tail is None:
+                return unicode(obj)
+            if self.tail == MANAGER:
+                return u'{{{0}}}'.format(u';'.join(
+                        self.sub_path(related)
+                        for related in getattr(obj, self.tail_name).all()
+                        ))
+            return walk_field_value(obj, self.tail_parts)
+        except Exception as e:
+            return _(u'Error: {0}').format(e)
+
+
+class CompiledSheetMapping(object):
+    """ Sheet mapping, compiled for model.
+
+    Besides accessors it contains the plan of related objects loading:
+    foreign key chains are passed to ``select_related`` and to-many
+    relations to ``prefetch_related``, so that the number of queries
+    does not depend on the number of rows.
+    """
+
+    def __init__(self, model, sheet_mapping):
+        self.model = model
+        self.captions = []
+        self.paths = []
+        for caption, parts in sheet_mapping:
+            self.captions.append(caption)
+            self.paths.append(FieldPath(model, parts))
+        self.select_related = self.plan_select_related(self.paths)
+        self.prefetch_related = self.plan_prefetch_related(self.paths)
+
+        self.columns = self.plan_columns()
+        self.object_paths = [
+                path
+                for path, lookup in zip(self.paths, self.columns)
+                if lookup is None]
+        self.object_select_related = self.plan_select_related(
+                self.object_paths)
+        self.object_prefetch_related = self.plan_prefetch_related(
+                self.object_paths)
+        self.object_fields = self.plan_object_fields()
+
+    def plan_select_related(self, paths):
+        """ Returns lookups for ``select_related``.
+        """
+        lookups = set()
+        for path in paths:
+            lookup = path.get_select_related()
+            if lookup:
+                lookups.add(lookup)
+        return sorted(lookups)
+
+    def plan_prefetch_related(self, paths):
+        """ Returns lookups for ``prefetch_related``.
+
+        If ``Prefetch`` objects are supported and all paths through
+        related manager read only plain fields of related objects,
+        then only these columns are loaded.
+        """
+        lookups = []
+        columns = {}
+        for path in paths:
+            for lookup, hop, sub_path in path.get_prefetch_related():
+                if lookup not in columns:
+                    lookups.append((lookup, hop))
+                    columns[lookup] = set()
+                if sub_path is None or columns[lookup] is None:
+                    continue
+                field = sub_path.get_plain_field()
+                if field is None:
+                    columns[lookup] = None
+                else:
+                    columns[lookup].add(field.name)
+
+        prefetch = []
+        for lookup, hop in lookups:
+            if Prefetch is None or hop is None or not columns[lookup]:
+                prefetch.append(lookup)
+                continue
+            kind, part, related_model, field = hop
+            fields = set(columns[lookup])
+            fields.add(related_model._meta.pk.name)
+            if isinstance(field, models.ForeignKey):
+                fields.add(field.name)
+            prefetch.append(Prefetch(
+                lookup,
+                queryset=related_model._default_manager.only(
+                    *sorted(fields))))
+        return prefetch
+
+    def plan_columns(self):
+        """ Returns lookups for ``values_list`` of paths, which read
+        database columns (``None`` for other paths).
+        """
+        return [path.get_column_lookup() for path in self.paths]
+
+    def plan_object_fields(self):
+        """ Returns names of fields, which have to be loaded for paths,
+        which do not read database columns, ``None`` if unknown.
+        """
+        needed = set()
+        for path in self.object_paths:
+            fields = path.get_needed_fields()
+            if fields is None:
+                return None
+            needed.update(fields)
+        needed.add(self.model._meta.pk.name)
+        return sorted(needed)
+
+    def iterate_rows(self, queryset, with_pk=False):
+        """ Yields rows (lists of unicode values) of queryset objects.
+
+        Paths, which read database columns, are fetched with
+        ``values_list`` and model instances are created only if there
+        are other paths. In that case they are loaded per chunk with
+        only the fields needed by these paths; if these fields are not
+        known (paths call methods), then all values are read from
+        model instances.
+
+        :param with_pk: if true, then primary key of object is prepended
+            to each row.
+        """
+        if with_pk:
+            prefix = lambda pk: [pk]
+        else:
+            prefix = lambda pk: []
+        columns = self.columns
+        lookups = [lookup for lookup in columns if lookup is not None]
+        if not lookups or (
+                self.object_paths and self.object_fields is None):
+            for obj in iterate_queryset(self.apply(queryset)):
+                yield prefix(obj.pk) + self(obj)
+            return
+
+        values = queryset.values_list('pk', *lookups)
+        get_pk = operator.itemgetter(0)
+        if len(lookups) == len(columns):
+            for row in iterate_queryset(values, get_pk=get_pk):
+                yield prefix(row[0]) + [
+                        unicode(value) for value in row[1:]]
+            return
+
+        objects = queryset.order_by().only(*self.object_fields)
+        if self.object_select_related:
+            objects = objects.select_related(*self.object_select_related)
+        if self.object_prefetch_related:
+            objects = objects.prefetch_related(
+                    *self.object_prefetch_related)
+
+        for chunk in iterate_chunks(values, get_pk=get_pk):
+            objects_chunk = objects.in_bulk([row[0] for row in chunk])
+            for row in chunk:
+                obj = objects_chunk.get(row[0])
+                values_iter = iter(row[1:])
+                yield prefix(row[0]) + [
+                        unicode(values_iter.next())
+                        if lookup is not None else path(obj)
+                        for path, lookup in zip(self.paths, columns)
+                        ]
+
+    def apply(self, queryset):
+        """ Returns queryset, which loads related objects needed by
+        mapping.
+        """
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+    def __call__(self, obj):
+        """ Returns list of object values.
+        """
+        return [path(obj) for path in self.paths]
+
+
+_compiled_mappings = {}
+
+
+def compile_sheet_mapping(model, sheet_mapping):
+    """ Returns cached :class:`CompiledSheetMapping` for model.
+    """
+    key = (model, tuple(
+        (caption, tuple(parts)) for caption, parts in sheet_mapping))
+    try:
+        return _compiled_mappings[key]
+    except KeyError:
+        compiled = CompiledSheetMapping(model, sheet_mapping)
+        _compiled_mappings[key] = compiled
+        return compiled
+
+
+def get_effective_ordering(queryset):
+    """ Returns ordering, which is used by queryset.
+    """
+    query = queryset.query
+    if query.extra_order_by:
+        return list(query.extra_order_by)
+    if query.order_by:
+        return list(query.order_by)
+    if query.default_ordering:
+        return list(queryset.model._meta.ordering)
+    return []
+
+
+def order_stably(queryset):
+    """ Orders queryset so that order of rows is stable.
+
+    :returns: pair ``(queryset, keyset)``, where ``keyset`` is list of
+        pairs ``(field, descending)`` of ordering or ``None``, if
+        queryset cannot be paginated by keyset (see
+        :func:`get_keyset`).
+    """
+    pk_name = queryset.model._meta.pk.name
+    ordering = get_effective_ordering(queryset)
+    if ordering in ([], ['pk'], [pk_name]):
+        queryset = queryset.order_by('pk')
+        ordering = ['pk']
+    elif not set(['pk', '-pk', pk_name, '-' + pk_name]) & set(ordering):
+        ordering = ordering + ['pk']
+        queryset = queryset.order_by(*ordering)
+    return queryset, get_keyset(queryset.model, ordering)
+
+
+def get_keyset(model, ordering):
+    """ Returns list of pairs ``(field, descending)`` for ordering or
+    ``None``, if ordering contains other items than not null columns
+    of model table (for them rows cannot be compared with ``__gt`` and
+    ``__lt`` lookups in the same way as database orders them).
+    """
+    opts = model._meta
+    keyset = []
+    for item in ordering:
+        if not isinstance(item, basestring):
+            return None
+        descending = item.startswith('-')
+        name = item[1:] if descending else item
+        if name == 'pk':
+            name = opts.pk.name
+        try:
+            field = opts.get_field(name, many_to_many=False)
+        except FieldDoesNotExist:
+            return None
+        if field.null or field.rel is not None:
+            # Relations are ordered by ordering of related model.
+            return None
+        keyset.append((field, descending))
+        if field.primary_key:
+            # Primary key makes ordering unique.
+            return keyset
+    return None
+
+
+def get_keyset_filter(keyset, values):
+    """ Returns filter, which selects rows, which come after row with
+    ``values`` of keyset fields.
+    """
+    condition = None
+    for i, (field, descending) in enumerate(keyset):
+        lookups = dict(
+                (keyset[j][0].name, values[j]) for j in range(i))
+        lookups[field.name + ('__lt' if descending else '__gt')] = (
+                values[i])
+        if condition is None:
+            condition = Q(**lookups)
+        else:
+            condition |= Q(**lookups)
+    return condition
+
+
+def get_keyset_values(queryset, keyset, item, get_pk):
+    """ Returns values of keyset fields of item or ``None``, if they
+    cannot be found (object was deleted).
+    """
+    if get_pk is None:
+        return [
+                getattr(item, field.attname)
+                for field, descending in keyset]
+    pk = get_pk(item)
+    if len(keyset) == 1:
+        return [pk]
+    values = list(queryset.model._base_manager.filter(pk=pk).values_list(
+        *[field.name for field, descending in keyset])[:1])
+    return values[0] if values else None
+
+
+def iterate_chunks(queryset, chunk_size=None, get_pk=None):
+    """ Yields lists of queryset objects, fetching them from database
+    in chunks of ``chunk_size`` rows, so that only one chunk is kept
+    in memory at a time.
+
+    Primary key is added to ordering to make it stable. If queryset is
+    ordered only by not null columns (for example, by ``-pk`` as admin
+    changelist orders it by default), then each chunk is selected by
+    filtering rows, which come after the last row of the previous
+    chunk, so that selecting each chunk costs the same. Otherwise
+    queryset is sliced with offsets.
+
+    :param get_pk: function, which returns primary key of yielded
+        item (needed for ``values_list`` querysets).
+    """
+    if chunk_size is None:
+        chunk_size = EXPORT_CHUNK_SIZE
+
+    queryset, keyset = order_stably(queryset)
+    offset = 0
+    last_values = None
+    while True:
+        if keyset is None:
+            chunk = queryset[offset:offset + chunk_size]
+        elif last_values is None:
+            chunk = queryset[:chunk_size]
+        else:
+            chunk = queryset.filter(
+                    get_keyset_filter(keyset, last_values))[:chunk_size]
+        chunk = list(chunk)
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        offset += chunk_size
+        if keyset is not None:
+            last_values = get_keyset_values(
+                    queryset, keyset, chunk[-1], get_pk)
+            if last_values is None:
+                # Last row was deleted, continue from its position.
+                keyset = None
+
+
+def iterate_queryset(queryset, chunk_size=None, get_pk=None):
+    """ Yields objects of queryset, fetching them in chunks.
+
+    See :func:`iterate_chunks`.
+    """
+    for chunk in iterate_chunks(queryset, chunk_size, get_pk):
+        for obj in chunk:
+            yield obj
+
+
+# Database connections inherited by worker process. They are kept
+# referenced, because closing them (also when they are garbage
+# collected) would close the session of parent process.
+_inherited_connections = []
+
+
+def reset_worker_connections():
+    """ Initializer of forked worker processes: makes worker to open
+    its own database connections instead of using ones inherited from
+    parent process. Parent connections are left untouched, so that
+    request transaction of parent is not ended.
+    """
+    for db_connection in connections.all():
+        if db_connection.connection is not None:
+            _inherited_connections.append(db_connection.connection)
+            db_connection.connection = None
+
+
+def export_shard(args):
+    """ Formats rows of one shard of parallel export.
+
+    Is run in worker process.
+
+    :param args: tuple ``(app_label, object_name, query, sheet_mapping,
+        pks)``.
+    :returns: list of rows in the same order as ``pks``.
+    """
+    app_label, object_name, query, sheet_mapping, pks = args
+    model = models.get_model(app_label, object_name)
+    queryset = model._default_manager.all()
+    queryset.query = query
+    mapping = compile_sheet_mapping(model, sheet_mapping)
+    rows = {}
+    for i in range(0, len(pks), EXPORT_CHUNK_SIZE):
+        for row in mapping.iterate_rows(
+                queryset.filter(pk__in=pks[i:i + EXPORT_CHUNK_SIZE]),
+                with_pk=True):
+            rows[row[0]] = row[1:]
+    return [rows[pk] for pk in pks if pk in rows]
+
+
+def iterate_rows_parallel(queryset, sheet_mapping, processes,
+                          shard_size=None):
+    """ Yields rows of queryset as :meth:`CompiledSheetMapping.iterate_rows`
+    does, but formats them in pool of worker processes.
+
+    Ordered list of primary keys is split into shards, which are
+    formatted by workers (each with its own database connection) and
+    merged in order, so the result is the same as of serial export.
+
+    Daemonic processes (for example, workers of ``nmadb_export_worker
+    --processes``) cannot start worker processes, so in them rows are
+    formatted serially.
+    """
+    if multiprocessing.current_process().daemon:
+        mapping = compile_sheet_mapping(queryset.model, sheet_mapping)
+        for row in mapping.iterate_rows(queryset):
+            yield row
+        return
+    if shard_size is None:
+        shard_size = EXPORT_SHARD_SIZE
+    opts = queryset.model._meta
+    pks = list(order_stably(queryset)[0].values_list('pk', flat=True))
+    shards = [
+            (opts.app_label, opts.object_name, queryset.query,
+             sheet_mapping, pks[i:i + shard_size])
+            for i in range(0, len(pks), shard_size)]
+    pool = multiprocessing.Pool(processes, reset_worker_connections)
+    try:
+        for rows in pool.imap(export_shard, shards):
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_auto_now_fields(model):
+    """ Returns date fields of model, which are updated on each save.
+    """
+    return [
+            field for field in model._meta.fields
+            if isinstance(field, models.DateField) and field.auto_now]
+
+
+def get_data_watermark(queryset):
+    """ Returns values, which change when queryset rows are added,
+    deleted or, if model has ``auto_now`` date fields, modified.
+
+    .. note::
+        Changes of related objects are not detected, so exports, which
+        show related objects fields, should use limited cache age.
+    """
+    aggregates = {'count': Count('pk'), 'max_pk': Max('pk')}
+    for field in get_auto_now_fields(queryset.model):
+        aggregates['max_' + field.name] = Max(field.name)
+    return sorted(queryset.order_by().aggregate(**aggregates).items())
+
+
+def get_export_key(queryset, writer_type, sheet_mapping):
+    """ Returns key, under which export of queryset is cached, or
+    ``None`` if queryset cannot be cached.
+
+    Exports of models without ``auto_now`` date fields are cached only
+    if ``NMADB_EXPORT_CACHE_MAX_AGE`` is set, because modifications of
+    their rows do not change the data watermark.
+    """
+    query = queryset.query
+    if query.low_mark or query.high_mark is not None:
+        return None
+    if (export_cache.max_age is None and
+            not get_auto_now_fields(queryset.model)):
+        return None
+    try:
+        sql, params = query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+    opts = queryset.model._meta
+    return cache.make_key(
+            opts.app_label, opts.object_name, writer_type,
+            format_sheet_mapping(sheet_mapping), sql, params,
+            get_data_watermark(queryset))
+
+
+class Echo(object):
+    """ File-like object, which returns written value instead of
+    storing it.
+    """
+
+    def write(self, value):
+        """ Returns value.
+        """
+        return value
+
+
+class CSVRowWriter(object):
+    """ Writer, which encodes rows as CSV one by one.
+    """
+
+    mime_type = 'text/csv'
+    file_extensions = ['csv']
+
+    def __init__(self, encoding='utf-8', **kwargs):
+        self.encoding = encoding
+        self.writer = csv.writer(Echo(), **kwargs)
+
+    def start(self):
+        """ Returns data, which has to be written before rows.
+        """
+        return ''
+
+    def write_row(self, row):
+        """ Returns encoded row.
+        """
+        return self.writer.writerow([
+            value.encode(self.encoding) for value in row])
+
+    def encode_chunk(self, data):
+        """ Returns final encoding of joined encoded rows.
+        """
+        return data
+
+    def finish(self):
+        """ Returns data, which has to be written after rows.
+        """
+        return ''
+
+
+class UTF16TabRowWriter(CSVRowWriter):
+    """ Writer, which encodes rows as tab separated values in UTF-16
+    with byte order mark (the format, which Excel opens directly).
+
+    Rows are written as UTF-8 (Python 2 ``csv`` module works only with
+    byte strings) and whole chunks are reencoded by incremental UTF-16
+    encoder, which writes byte order mark only once.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('delimiter', '\t')
+        super(UTF16TabRowWriter, self).__init__(encoding='utf-8', **kwargs)
+        self.encoder = codecs.getincrementalencoder('utf-16')()
+
+    def start(self):
+        """ Returns byte order mark.
+        """
+        return self.encoder.encode(u'')
+
+    def encode_chunk(self, data):
+        """ Returns chunk reencoded to UTF-16.
+        """
+        return self.encoder.encode(data.decode('utf-8'))
+
+    def finish(self):
+        """ Returns data, which has to be written after rows.
+        """
+        return self.encoder.encode(u'', True)
+
+
+ROW_WRITERS = {
+        u'CSV': CSVRowWriter,
+        u'UTF16Tab': UTF16TabRowWriter,
+        }
+
+
+def stream_rows(rows, writer, rows_per_chunk=100):
+    """ Yields encoded chunks of rows.
+
+    :param rows: iterable of rows (lists of unicode values).
+    :param writer: row writer instance.
+    """
+    yield writer.start()
+    chunk = []
+    for row in rows:
+        chunk.append(writer.write_row(row))
+        if len(chunk) >= rows_per_chunk:
+            yield writer.encode_chunk(''.join(chunk))
+            chunk = []
+    if chunk:
+        yield writer.encode_chunk(''.join(chunk))
+    yield writer.finish()
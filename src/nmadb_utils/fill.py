@@ -0,0 +1,330 @@
+""" Helpers for filling missing sheet data from database.
+"""
+
+
+import codecs
+import csv
+import itertools
+import operator
+import os
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+
+from nmadb_utils import export
+from nmadb_utils import ods
+
+
+FILL_BATCH_SIZE = getattr(settings, 'NMADB_FILL_BATCH_SIZE', 500)
+
+# If uploaded sheet has at least this part of table rows, then instead
+# of batched queries table is scanned once.
+FILL_SCAN_RATIO = getattr(settings, 'NMADB_FILL_SCAN_RATIO', 0.5)
+
+# Extensions of files, which can be read by :func:`read_sheets`.
+READ_EXTENSIONS = (u'csv', u'ods')
+
+# Number of bytes at the beginning of uploaded CSV file, which are
+# checked to be correctly encoded before response is started.
+CSV_CHECK_SIZE = getattr(settings, 'NMADB_FILL_CSV_CHECK_SIZE', 64 * 1024)
+
+
+def resolve_lookup_field(model, parts):
+    """ Returns the field, which is compared by lookup, described by
+    parts, or ``None`` if it cannot be found.
+    """
+    field = None
+    for i, part in enumerate(parts):
+        if model is None:
+            return None
+        kind, next_model, field = export.resolve_part(model, part)
+        if kind not in (export.ATTRIBUTE, export.MANAGER):
+            return None
+        if next_model is not None and i == len(parts) - 1:
+            if not isinstance(field, models.ForeignKey) or (
+                    field.rel.to is not next_model):
+                return None
+            field = field.rel.get_related_field()
+        model = next_model
+    return field
+
+
+def batches(iterable, size):
+    """ Yields lists of at most ``size`` items of iterable.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class KeyResolver(object):
+    """ Finds objects of model by key values given in uploaded sheet
+    rows and returns mapped values of found objects.
+
+    Rows are resolved in batches: each batch is looked up with one
+    query and matched back to rows through dictionary indexed by
+    normalized key values. If sheet covers large part of table, then
+    all rows can be resolved at once by scanning the key columns of
+    table (see :meth:`should_scan`). The result for each row is the
+    same as of ``klass.objects.get(**query)`` with the row query.
+
+    Database may compare text differently than Python (for example,
+    case insensitively with MySQL ``*_ci`` collations), so rows with
+    text keys, which are not matched exactly, are looked up with
+    ``get``.
+    """
+
+    def __init__(self, klass, mapping, lookups):
+        """
+        :param mapping: :class:`nmadb_utils.export.CompiledSheetMapping`.
+        :param lookups: list of lookups (``__`` joined parts), which
+            are used as keys.
+        """
+        self.klass = klass
+        self.mapping = mapping
+        self.lookups = list(lookups)
+        self.fields = [
+                resolve_lookup_field(klass, lookup.split(u'__'))
+                for lookup in self.lookups]
+        self.batch = bool(self.lookups) and None not in self.fields
+        self.text_keys = self.batch and any(
+                isinstance(field, (models.CharField, models.TextField))
+                for field in self.fields)
+        self._empty_result = None
+
+    def normalize(self, values):
+        """ Returns key, which is compared instead of values.
+        """
+        return tuple(
+                field.to_python(value)
+                for field, value in zip(self.fields, values))
+
+    def get(self, query):
+        """ Finds object by query as it was done by ``get``.
+
+        :returns: pair ``(values, exception)``.
+        """
+        try:
+            obj = self.klass.objects.get(**query)
+        except Exception as e:
+            return None, e
+        else:
+            return self.mapping(obj), None
+
+    def should_scan(self, rows_count):
+        """ Checks if it is cheaper to scan table than to make batched
+        queries for ``rows_count`` rows.
+        """
+        if not self.batch:
+            return False
+        return rows_count >= self.klass.objects.count() * FILL_SCAN_RATIO
+
+    def scan(self, keys):
+        """ Returns dictionary, which maps normalized keys to lists of
+        primary keys of found objects, built by scanning key columns
+        of the whole table. Only keys in ``keys`` are indexed.
+        """
+        found = {}
+        queryset = self.klass.objects.order_by().values_list(
+                'pk', *self.lookups)
+        for row in queryset.iterator():
+            key = self.normalize(row[1:])
+            if key in keys:
+                found.setdefault(key, []).append(row[0])
+        return found
+
+    def load_values(self, pks):
+        """ Returns dictionary, which maps primary keys to mapped
+        values of objects.
+        """
+        pks = list(pks)
+        values = {}
+        for i in range(0, len(pks), FILL_BATCH_SIZE):
+            queryset = self.klass.objects.filter(
+                    pk__in=pks[i:i + FILL_BATCH_SIZE])
+            for row in self.mapping.iterate_rows(queryset, with_pk=True):
+                values[row[0]] = row[1:]
+        return values
+
+    def find(self, queries):
+        """ Returns dictionary, which maps normalized keys to lists of
+        primary keys of found objects (one per each row returned by
+        database, as ``get`` would count them).
+        """
+        if len(self.lookups) == 1:
+            lookup = self.lookups[0]
+            queryset = self.klass.objects.filter(**{
+                lookup + u'__in': list(set(
+                    query[lookup] for query in queries))})
+        else:
+            queryset = self.klass.objects.filter(reduce(operator.or_, [
+                Q(**query) for query in queries]))
+        found = {}
+        for row in queryset.order_by().values_list('pk', *self.lookups):
+            found.setdefault(self.normalize(row[1:]), []).append(row[0])
+        return found
+
+    def resolve(self, queries, scan=False):
+        """ Resolves queries (dictionaries mapping lookups to values).
+
+        :param scan: if true, then table is scanned instead of querying
+            for the given keys.
+        :returns: list of pairs ``(values, exception)``.
+        """
+        if not self.lookups:
+            if self._empty_result is None:
+                self._empty_result = self.get({})
+            return [self._empty_result] * len(queries)
+        if not self.batch:
+            return [self.get(query) for query in queries]
+
+        results = [None] * len(queries)
+        keys = {}
+        for i, query in enumerate(queries):
+            try:
+                key = self.normalize(
+                        [query[lookup] for lookup in self.lookups])
+            except Exception:
+                results[i] = self.get(query)
+            else:
+                keys.setdefault(key, []).append(i)
+        if not keys:
+            return results
+
+        if scan:
+            found = self.scan(keys)
+        else:
+            found = self.find(
+                    [queries[indexes[0]] for indexes in keys.values()])
+        pks = set()
+        for key in keys:
+            objects = found.get(key, ())
+            if len(objects) == 1:
+                pks.add(objects[0])
+        values = self.load_values(pks)
+
+        object_name = self.klass._meta.object_name
+        for key, indexes in keys.items():
+            objects = found.get(key, ())
+            if len(objects) > 1:
+                result = None, self.klass.MultipleObjectsReturned(
+                        "get() returned more than one %s -- it returned "
+                        "%s!" % (object_name, len(objects)))
+            elif objects and objects[0] in values:
+                result = values[objects[0]], None
+            elif self.text_keys:
+                result = self.get(queries[indexes[0]])
+            else:
+                result = None, self.klass.DoesNotExist(
+                        "%s matching query does not exist." %
+                        object_name)
+            for i in indexes:
+                results[i] = result
+        return results
+
+
+def get_file_extension(file_name):
+    """ Returns lowercase extension of file name without dot.
+    """
+    return os.path.splitext(file_name)[1][1:].lower()
+
+
+def get_csv_encoding(start):
+    """ Returns encoding of CSV file, which starts with given bytes.
+    """
+    if start[:len(codecs.BOM_UTF16_LE)] in (
+            codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    return 'utf-8'
+
+
+def is_csv_readable(input):
+    """ Checks if the beginning of CSV file can be decoded by
+    :func:`read_csv_rows`.
+    """
+    input.seek(0)
+    block = input.read(CSV_CHECK_SIZE)
+    input.seek(0)
+    decoder = codecs.getincrementaldecoder(get_csv_encoding(block))()
+    try:
+        # Block can end in the middle of character.
+        text = decoder.decode(block, len(block) < CSV_CHECK_SIZE)
+    except UnicodeDecodeError:
+        return False
+    # ``csv`` module rejects null bytes (for example, of UTF-16 file
+    # without byte order mark).
+    return u'\0' not in text
+
+
+def read_csv_rows(input):
+    """ Yields rows of CSV file as lists of unicode values.
+
+    UTF-8 files are read as comma separated, and UTF-16 files (with
+    byte order mark, as written by
+    :class:`nmadb_utils.export.UTF16TabRowWriter`) as tab separated.
+    """
+    input.seek(0)
+    start = input.read(len(codecs.BOM_UTF16_LE))
+    input.seek(0)
+    if get_csv_encoding(start) == 'utf-16':
+        # Python 2 ``csv`` module works only with byte strings.
+        lines = (
+                line.encode('utf-8')
+                for line in codecs.getreader('utf-16')(input))
+        reader = csv.reader(lines, delimiter='\t')
+    else:
+        lines = iter(input)
+        first = next(lines, '')
+        if first.startswith(codecs.BOM_UTF8):
+            first = first[len(codecs.BOM_UTF8):]
+        reader = csv.reader(itertools.chain([first], lines))
+    for row in reader:
+        yield [value.decode('utf-8') for value in row]
+
+
+class StreamedSheet(object):
+    """ Sheet, which rows are read from file while iterating, so they
+    can be iterated only once. Rows are dictionaries mapping captions
+    (values of the first row) to values.
+    """
+
+    streaming = True
+
+    def __init__(self, name, rows):
+        """
+        :param rows: iterable of lists of values.
+        """
+        self.name = name
+        self.rows = iter(rows)
+        self.captions = next(self.rows, [])
+
+    def __iter__(self):
+        width = len(self.captions)
+        for values in self.rows:
+            values = values[:width] + [u''] * (width - len(values))
+            yield dict(zip(self.captions, values))
+
+
+def read_sheets(uploaded_file, sheet_name):
+    """ Yields :class:`StreamedSheet` for each sheet of uploaded CSV or
+    ODS file. Rows of sheet have to be consumed before the next sheet.
+
+    :param sheet_name: name of sheet read from CSV file.
+    """
+    extension = get_file_extension(uploaded_file.name)
+    if extension == u'ods':
+        rows = ods.read_rows(uploaded_file)
+    elif extension == u'csv':
+        rows = (
+                (sheet_name, values)
+                for values in read_csv_rows(uploaded_file))
+    else:
+        raise ValueError(u'Unsupported file type: {0}'.format(extension))
+    for name, sheet_rows in itertools.groupby(rows, operator.itemgetter(0)):
+        yield StreamedSheet(name, (values for row_name, values in sheet_rows))
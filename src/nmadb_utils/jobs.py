@@ -0,0 +1,197 @@
+""" Running of background export jobs.
+
+Jobs are stored in :class:`nmadb_utils.models.ExportJob` table, which
+is used as a queue, and are run by ``nmadb_export_worker`` management
+command.
+"""
+
+
+import datetime
+import multiprocessing
+import os
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from nmadb_utils import models
+
+
+# Running jobs, which were started more than this number of seconds
+# ago, are considered abandoned by crashed or killed workers and are
+# marked as failed. If ``None``, jobs are never timed out.
+EXPORT_JOBS_TIMEOUT = getattr(settings, 'NMADB_EXPORT_JOBS_TIMEOUT', 3600)
+
+# Finished jobs (and their files) are deleted after this number of
+# seconds. If ``None``, jobs are kept until deleted in admin.
+EXPORT_JOBS_MAX_AGE = getattr(
+        settings, 'NMADB_EXPORT_JOBS_MAX_AGE', 7 * 24 * 3600)
+
+
+def get_exporter(model):
+    """ Returns object, which is used to export objects of model.
+    """
+    from django.contrib import admin
+    from nmadb_utils.admin import DownloadSelectedMixin
+
+    model_admin = admin.site._registry.get(model)
+    if isinstance(model_admin, DownloadSelectedMixin):
+        return model_admin
+    return DownloadSelectedMixin()
+
+
+def claim_job(job_pk):
+    """ Marks pending job as running.
+
+    :returns: job object or ``None`` if job was already claimed by
+        another worker.
+    """
+    claimed = models.ExportJob.objects.filter(
+            pk=job_pk, status=models.ExportJob.PENDING).update(
+                    status=models.ExportJob.RUNNING,
+                    started=timezone.now())
+    if not claimed:
+        return None
+    return models.ExportJob.objects.get(pk=job_pk)
+
+
+def get_temp_path(job_pk):
+    """ Returns path of file, into which job writes until it finishes.
+    """
+    return os.path.join(
+            models.EXPORT_JOBS_DIR, u'job-{0}.part'.format(job_pk))
+
+
+def remove_file(path):
+    """ Removes file, if it exists.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def run_job(job_pk):
+    """ Runs pending export job and writes generated file into
+    ``NMADB_EXPORT_JOBS_DIR``.
+
+    :returns: ``True`` if job was run by this call.
+    """
+    job = claim_job(job_pk)
+    if job is None:
+        return False
+
+    if not os.path.isdir(models.EXPORT_JOBS_DIR):
+        os.makedirs(models.EXPORT_JOBS_DIR)
+    temp_path = get_temp_path(job.pk)
+    # Job could be marked as failed by :func:`fail_stale_jobs`, if it
+    # was running too long, so it is finished only if it is running.
+    running = models.ExportJob.objects.filter(
+            pk=job.pk, status=models.ExportJob.RUNNING)
+    try:
+        exporter = get_exporter(job.get_model())
+        with open(temp_path, 'wb') as output:
+            writer = exporter.write_selected(
+                    output, job.get_queryset(), job.writer,
+                    job.get_sheet_mapping())
+        file_name = u'job-{0}.{1}'.format(
+                job.pk, writer.file_extensions[0])
+        os.rename(temp_path, os.path.join(models.EXPORT_JOBS_DIR, file_name))
+    except Exception:
+        remove_file(temp_path)
+        running.update(
+                status=models.ExportJob.FAILED,
+                finished=timezone.now(),
+                error=traceback.format_exc())
+    else:
+        finished = running.update(
+                status=models.ExportJob.DONE,
+                finished=timezone.now(),
+                file_name=file_name,
+                content_type=writer.mime_type)
+        if not finished:
+            remove_file(os.path.join(models.EXPORT_JOBS_DIR, file_name))
+    return True
+
+
+def fail_stale_jobs():
+    """ Marks jobs, which are running longer than
+    ``NMADB_EXPORT_JOBS_TIMEOUT`` seconds, as failed: their workers
+    most likely crashed or were killed.
+
+    :returns: number of failed jobs.
+    """
+    if EXPORT_JOBS_TIMEOUT is None:
+        return 0
+    now = timezone.now()
+    stale = models.ExportJob.objects.filter(
+            status=models.ExportJob.RUNNING,
+            started__lt=now - datetime.timedelta(
+                seconds=EXPORT_JOBS_TIMEOUT))
+    job_pks = list(stale.values_list('pk', flat=True))
+    failed = stale.filter(pk__in=job_pks).update(
+            status=models.ExportJob.FAILED,
+            finished=now,
+            error=u'Job did not finish in {0} seconds.'.format(
+                EXPORT_JOBS_TIMEOUT))
+    for job_pk in job_pks:
+        remove_file(get_temp_path(job_pk))
+    return failed
+
+
+def delete_expired_jobs():
+    """ Deletes jobs (together with generated files), which finished
+    more than ``NMADB_EXPORT_JOBS_MAX_AGE`` seconds ago.
+    """
+    if EXPORT_JOBS_MAX_AGE is None:
+        return
+    models.ExportJob.objects.filter(
+            status__in=(models.ExportJob.DONE, models.ExportJob.FAILED),
+            finished__lt=timezone.now() - datetime.timedelta(
+                seconds=EXPORT_JOBS_MAX_AGE)).delete()
+
+
+def run_jobs(job_pks, processes=1):
+    """ Runs export jobs in pool of ``processes`` worker processes.
+
+    :returns: number of jobs run.
+    """
+    if processes <= 1 or len(job_pks) <= 1:
+        return sum(1 for job_pk in job_pks if run_job(job_pk))
+    # Forked workers must not share parent database connection.
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return sum(1 for done in pool.imap_unordered(run_job, job_pks)
+                   if done)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_worker(processes=1, poll_interval=5, once=False):
+    """ Runs pending export jobs in a loop.
+
+    Abandoned running jobs are failed and expired jobs are deleted
+    before pending jobs are taken (see :func:`fail_stale_jobs` and
+    :func:`delete_expired_jobs`).
+
+    :param once: if true, then returns when there are no pending jobs.
+    """
+    while True:
+        fail_stale_jobs()
+        delete_expired_jobs()
+        job_pks = list(models.ExportJob.objects.filter(
+            status=models.ExportJob.PENDING).order_by(
+                'created').values_list('pk', flat=True)[:processes])
+        if job_pks:
+            run_jobs(job_pks, processes)
+            continue
+        if once:
+            return
+        # Closing connection ends transaction, so that jobs created
+        # meanwhile are seen by the next query.
+        connection.close()
+        time.sleep(poll_interval)
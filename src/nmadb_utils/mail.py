@@ -2,8 +2,573 @@
 """
 
 
+import collections
+import mimetypes
+import smtplib
+import socket
+import threading
+import time
+import Queue
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.conf import settings
 from django.core import mail
-from django.utils.encoding import smart_str
+from django.core.mail.message import sanitize_address
+from django.dispatch import Signal
+from django.template import Context, Template
+from django.utils.encoding import force_bytes, force_text
+from django.utils.translation import ugettext as _
+
+
+# Number of messages sent before pausing for ``MAIL_BATCH_PAUSE``
+# seconds (used to stay within provider rate limits).
+MAIL_BATCH_SIZE = getattr(settings, 'NMADB_MAIL_BATCH_SIZE', 100)
+MAIL_BATCH_PAUSE = getattr(settings, 'NMADB_MAIL_BATCH_PAUSE', 0)
+
+# How many times connection is reopened for the same message after
+# server closed it.
+MAIL_RECONNECT_ATTEMPTS = getattr(settings, 'NMADB_MAIL_RECONNECT_ATTEMPTS', 3)
+
+# Number of threads, which send messages concurrently, each through its
+# own connection.
+MAIL_WORKERS = getattr(settings, 'NMADB_MAIL_WORKERS', 1)
+# Maximum number of messages sent per second by all workers or ``None``.
+MAIL_RATE = getattr(settings, 'NMADB_MAIL_RATE', None)
+
+# How many times message is resent after temporary failure. Before
+# n-th retry sending waits for ``MAIL_RETRY_DELAY * 2 ** (n - 1)``
+# seconds.
+MAIL_RETRIES = getattr(settings, 'NMADB_MAIL_RETRIES', 2)
+MAIL_RETRY_DELAY = getattr(settings, 'NMADB_MAIL_RETRY_DELAY', 1)
+
+
+# Sent with ``report`` and ``result`` arguments after each message is
+# delivered or finally failed. Note that in concurrent mode receivers
+# are called from worker threads.
+mail_sent = Signal(providing_args=['report', 'result'])
+mail_failed = Signal(providing_args=['report', 'result', 'error'])
+# Sent with ``report`` argument, when all messages are processed.
+mass_mail_finished = Signal(providing_args=['report'])
+
+
+def is_disconnect(error):
+    """ Checks if error means that server closed the connection.
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, socket.error)):
+        return True
+    return getattr(error, 'smtp_code', None) == 421
+
+
+def get_error_code(error):
+    """ Returns SMTP response code of error or ``None``.
+    """
+    code = getattr(error, 'smtp_code', None)
+    if code is None and isinstance(error, smtplib.SMTPRecipientsRefused):
+        for code, message in error.recipients.values():
+            break
+    return code
+
+
+def is_temporary(error):
+    """ Checks if sending, which failed with error, may succeed later.
+    """
+    if is_disconnect(error):
+        return True
+    code = get_error_code(error)
+    return code is not None and 400 <= code < 500
+
+
+class RecipientResult(object):
+    """ Result of delivery to one recipient.
+    """
+
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, address, status, code=None, error=u'', retries=0,
+                 send_time=0.0, size=0):
+        """
+        :param code: SMTP response code.
+        :param retries: number of resends after failures.
+        :param send_time: seconds spent sending (including retries).
+        :param size: size of message in bytes.
+        """
+        self.address = address
+        self.status = status
+        self.code = code
+        self.error = error
+        self.retries = retries
+        self.send_time = send_time
+        self.size = size
+
+    def as_dict(self):
+        """ Returns result as dictionary, which can be serialized.
+        """
+        return dict(self.__dict__)
+
+
+class DeliveryReport(object):
+    """ Report of mass mail delivery.
+
+    Report can be serialized with :meth:`as_dict` and passed again to
+    delivery function to resume it: recipients, to whom messages were
+    already sent, are skipped.
+    """
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.started = None
+        self.finished = None
+        self.duration = 0.0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.connect_time = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Restores report, serialized with :meth:`as_dict`.
+        """
+        report = cls()
+        for key, value in data.items():
+            if key != 'results':
+                setattr(report, key, value)
+        for result in data['results']:
+            report.results[result['address']] = RecipientResult(**result)
+        return report
+
+    def as_dict(self):
+        """ Returns report as dictionary, which can be serialized.
+        """
+        data = dict(
+                (key, getattr(self, key))
+                for key in (
+                    'started', 'finished', 'duration', 'messages_sent',
+                    'bytes_sent',
+                    'connections', 'connect_time'))
+        data['results'] = [
+                result.as_dict() for result in self.results.values()]
+        return data
+
+    def record(self, message, result):
+        """ Records result of sending message to all its recipients.
+        """
+        with self.lock:
+            if result.status == RecipientResult.SENT:
+                self.messages_sent += 1
+                self.bytes_sent += result.size
+            for address in message.recipients():
+                self.results[address] = RecipientResult(
+                        **dict(result.as_dict(), address=address))
+
+    def record_connections(self, connections):
+        """ Adds statistics of used connections.
+        """
+        for connection in connections:
+            self.connections += connection.connects
+            self.connect_time += connection.connect_time
+
+    def is_sent(self, address):
+        """ Checks if message was sent to address.
+        """
+        result = self.results.get(address)
+        return result is not None and result.status == RecipientResult.SENT
+
+    def get_failed(self):
+        """ Returns results of failed recipients.
+        """
+        return [
+                result for result in self.results.values()
+                if result.status == RecipientResult.FAILED]
+
+    def get_duration(self):
+        """ Returns duration of delivery in seconds (of all runs, if
+        delivery was resumed).
+        """
+        if self.started is not None and self.finished is None:
+            return self.duration + time.time() - self.started
+        return self.duration
+
+    def get_throughput(self):
+        """ Returns number of sent messages per second.
+        """
+        duration = self.get_duration()
+        return self.messages_sent / duration if duration else 0.0
+
+
+class MailConnection(object):
+    """ SMTP connection, which is kept open for sending many messages
+    and is transparently reopened if server closes it.
+    """
+
+    def __init__(self, reconnect_attempts=None, **backend_args):
+        if reconnect_attempts is None:
+            reconnect_attempts = MAIL_RECONNECT_ATTEMPTS
+        self.reconnect_attempts = reconnect_attempts
+        self.backend_args = backend_args
+        self.backend_args.setdefault('use_tls', True)
+        self.backend = None
+        self.connects = 0
+        self.connect_time = 0.0
+
+    def open(self):
+        """ Opens connection, if it is not opened yet.
+        """
+        if self.backend is None:
+            started = time.time()
+            backend = mail.get_connection(
+                    fail_silently=False, **self.backend_args)
+            backend.open()
+            self.backend = backend
+            self.connects += 1
+            self.connect_time += time.time() - started
+
+    def close(self):
+        """ Closes connection. Errors are ignored, because connection
+        may be already closed by server.
+        """
+        backend, self.backend = self.backend, None
+        if backend is not None:
+            try:
+                backend.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+    def send(self, message):
+        """ Sends message, reconnecting if needed.
+
+        If SMTP backend is used, then message is passed to ``smtplib``
+        directly, otherwise it is sent by backend.
+
+        :returns: size of message in bytes.
+        """
+        data = None
+        for attempt in range(self.reconnect_attempts + 1):
+            try:
+                self.open()
+                smtp = getattr(self.backend, 'connection', None)
+                if data is None:
+                    data = encode_message(message)
+                if isinstance(smtp, smtplib.SMTP):
+                    smtp.sendmail(*data)
+                else:
+                    self.backend.send_messages([message])
+                return len(data[2])
+            except Exception as e:
+                if not is_disconnect(e) or (
+                        attempt == self.reconnect_attempts):
+                    raise
+                self.close()
+
+
+def encode_message(message):
+    """ Returns arguments for ``smtplib.SMTP.sendmail``, the same as
+    Django SMTP backend passes.
+    """
+    from_email = sanitize_address(message.from_email, message.encoding)
+    recipients = [
+            sanitize_address(address, message.encoding)
+            for address in message.recipients()]
+    mime_message = message.message()
+    charset = mime_message.get_charset()
+    charset = charset.get_output_charset() if charset else 'utf-8'
+    return (
+            from_email, recipients,
+            force_bytes(mime_message.as_string(), charset))
+
+
+class ConnectionPool(object):
+    """ Bounded pool of :class:`MailConnection` objects, which can be
+    shared by threads.
+    """
+
+    def __init__(self, size, **backend_args):
+        self.size = size
+        self.backend_args = backend_args
+        self.connections = []
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns idle connection, creating new one if pool is not
+        full yet, or waits until some connection is released.
+        """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if len(self.connections) < self.size:
+                connection = MailConnection(**self.backend_args)
+                self.connections.append(connection)
+                return connection
+        return self.idle.get()
+
+    def release(self, connection):
+        """ Returns connection to pool.
+        """
+        self.idle.put(connection)
+
+    def close(self):
+        """ Closes all connections.
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+class TokenBucket(object):
+    """ Rate limiter, which allows ``rate`` actions per second on
+    average and bursts of at most ``capacity`` actions. Can be shared
+    by threads.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Waits until action is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_attachment(label, data, mimetype=None):
+    """ Creates base64 encoded MIME attachment, which can be attached to
+    many messages without encoding it again.
+    """
+    if mimetype is None:
+        mimetype = (
+                mimetypes.guess_type(label)[0] or
+                'application/octet-stream')
+    if hasattr(data, 'read'):
+        data = data.read()
+    basetype, subtype = mimetype.split('/', 1)
+    attachment = MIMEBase(basetype, subtype)
+    attachment.set_payload(data)
+    encoders.encode_base64(attachment)
+    filename = force_text(label)
+    try:
+        filename = filename.encode('ascii')
+    except UnicodeEncodeError:
+        filename = ('utf-8', '', filename.encode('utf-8'))
+    attachment.add_header(
+            'Content-Disposition', 'attachment', filename=filename)
+    return attachment
+
+
+def generate_messages(email_addresses, title, text, from_email,
+                      attachments=()):
+    """ Yields messages for each email address.
+
+    :param attachments: list of MIME attachments, which are shared by
+        all messages (see :func:`create_attachment`).
+    """
+    for email_address in email_addresses:
+        email = mail.EmailMessage(title)
+        email.body = text
+        email.from_email = from_email
+        email.to = [email_address]
+        for attachment in attachments:
+            email.attach(attachment)
+        yield email
+
+
+def send_message(connection, message, report, retries=None,
+                 retry_delay=None):
+    """ Sends message, retrying after temporary failures, and records
+    result into report.
+
+    :returns: ``True`` if message was sent.
+    """
+    if retries is None:
+        retries = MAIL_RETRIES
+    if retry_delay is None:
+        retry_delay = MAIL_RETRY_DELAY
+    started = time.time()
+    attempt = 0
+    while True:
+        try:
+            size = connection.send(message)
+        except Exception as e:
+            if attempt < retries and is_temporary(e):
+                time.sleep(retry_delay * 2 ** attempt)
+                attempt += 1
+                continue
+            result = RecipientResult(
+                    None, RecipientResult.FAILED, get_error_code(e),
+                    force_text(repr(e)), attempt, time.time() - started)
+            report.record(message, result)
+            mail_failed.send(
+                    sender=DeliveryReport, report=report, result=result,
+                    error=e)
+            return False
+        result = RecipientResult(
+                None, RecipientResult.SENT, 250, u'', attempt,
+                time.time() - started, size)
+        report.record(message, result)
+        mail_sent.send(sender=DeliveryReport, report=report, result=result)
+        return True
+
+
+def generate_templated_messages(recipients, subject_template,
+                                text_template, from_email,
+                                html_template=None, attachments=()):
+    """ Yields personalized messages for each recipient.
+
+    :param recipients: iterable of pairs ``(email_address, context)``,
+        where context is dictionary.
+    :param subject_template: compiled template of message subject.
+    :param text_template: compiled template of plain text body.
+    :param html_template: compiled template of HTML body or ``None``.
+    :param attachments: list of MIME attachments, which are shared by
+        all messages (see :func:`create_attachment`).
+    """
+    for email_address, context in recipients:
+        text_context = Context(context, autoescape=False)
+        subject = u' '.join(
+                subject_template.render(text_context).splitlines())
+        email = mail.EmailMultiAlternatives(subject)
+        email.body = text_template.render(text_context)
+        if html_template is not None:
+            email.attach_alternative(
+                    html_template.render(Context(context)), 'text/html')
+        email.from_email = from_email
+        email.to = [email_address]
+        for attachment in attachments:
+            email.attach(attachment)
+        yield email
+
+
+def deliver_messages(messages, connection, report, batch_size=None,
+                     batch_pause=None, rate_limiter=None, **kwargs):
+    """ Sends messages through connection, after each ``batch_size``
+    messages pausing for ``batch_pause`` seconds.
+
+    :param connection: :class:`MailConnection`.
+    :param report: :class:`DeliveryReport`.
+    :param rate_limiter: :class:`TokenBucket` or ``None``.
+    :param kwargs: passed to :func:`send_message`.
+    """
+    if batch_size is None:
+        batch_size = MAIL_BATCH_SIZE
+    if batch_pause is None:
+        batch_pause = MAIL_BATCH_PAUSE
+    count = 0
+    for email in messages:
+        if count and batch_pause and count % batch_size == 0:
+            time.sleep(batch_pause)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        send_message(connection, email, report, **kwargs)
+        count += 1
+
+
+def deliver_messages_concurrently(messages, pool, workers, report,
+                                  rate_limiter=None, **kwargs):
+    """ Sends messages from ``workers`` threads, each taking connection
+    from pool. If messages cannot be generated, then all workers are
+    stopped and the error is raised.
+
+    :param pool: :class:`ConnectionPool`.
+    :param report: :class:`DeliveryReport`.
+    :param rate_limiter: :class:`TokenBucket` or ``None``.
+    :param kwargs: passed to :func:`send_message`.
+    """
+    lock = threading.Lock()
+    messages = iter(messages)
+    errors = []
+
+    def work():
+        """ Sends messages until there are no more or generating them
+        failed.
+        """
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    email = next(messages)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    errors.append(e)
+                    return
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            connection = pool.acquire()
+            try:
+                send_message(connection, email, report, **kwargs)
+            finally:
+                pool.release(connection)
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def deliver(messages, report=None, batch_size=None, batch_pause=None,
+            workers=None, rate=None, retries=None, retry_delay=None,
+            **backend_args):
+    """ Sends messages through one connection or, if ``workers`` is more
+    than one, concurrently by that many threads, each through its own
+    connection (batch pauses are not used then). ``rate`` limits number
+    of messages sent per second.
+
+    :param report: :class:`DeliveryReport`, to which results are added.
+    :returns: delivery report.
+    """
+    if report is None:
+        report = DeliveryReport()
+    if workers is None:
+        workers = MAIL_WORKERS
+    if rate is None:
+        rate = MAIL_RATE
+    rate_limiter = TokenBucket(rate) if rate else None
+    kwargs = {'retries': retries, 'retry_delay': retry_delay}
+    report.started = time.time()
+    report.finished = None
+    if workers > 1:
+        pool = ConnectionPool(workers, **backend_args)
+        try:
+            deliver_messages_concurrently(
+                    messages, pool, workers, report, rate_limiter,
+                    **kwargs)
+        finally:
+            pool.close()
+            report.record_connections(pool.connections)
+    else:
+        connection = MailConnection(**backend_args)
+        try:
+            deliver_messages(
+                    messages, connection, report, batch_size,
+                    batch_pause, rate_limiter, **kwargs)
+        finally:
+            connection.close()
+            report.record_connections([connection])
+    report.finished = time.time()
+    report.duration += report.finished - report.started
+    mass_mail_finished.send(sender=DeliveryReport, report=report)
+    return report
 
 
 def send_mass_mail(
@@ -11,9 +576,30 @@ def send_mass_mail(
         attachment1=None, attachment1_label=None,
         attachment2=None, attachment2_label=None,
         attachment3=None, attachment3_label=None,
-        **backend_args):
+        batch_size=None, batch_pause=None, attachments=(),
+        report=None, **kwargs):
     """ Sends emails using custom connection.
 
+    All messages are sent through one connection, which is kept open
+    for the whole run. After each ``batch_size`` messages sending is
+    paused for ``batch_pause`` seconds. Messages are created one by
+    one while sending, so ``email_addresses`` may be any iterable.
+
+    Messages, which could not be sent, are retried with exponential
+    backoff and, if still failing, recorded as failed without stopping
+    the delivery. Other keyword arguments are passed to :func:`deliver`
+    (for concurrency, rate limit and retries settings) and to email
+    backend.
+
+    :param report: report of interrupted run; recipients, to whom
+        message was already sent, are skipped.
+    :returns: :class:`DeliveryReport`.
+
+    :param attachments: list of pairs ``(label, file)`` or triples
+        ``(label, file, mimetype)``; file may also be a string with
+        attachment data. ``attachmentN`` and ``attachmentN_label``
+        arguments are added before them.
+
     .. todo::
         Add support for HTML emails (maybe with images). Urls:
 
@@ -23,30 +609,63 @@ def send_mass_mail(
 
     """
 
-    attachment1_data = attachment1.read() if attachment1 else None
-    attachment2_data = attachment2.read() if attachment2 else None
-    attachment3_data = attachment3.read() if attachment3 else None
+    attachments_list = []
+    for i, (attachment, label) in enumerate((
+            (attachment1, attachment1_label),
+            (attachment2, attachment2_label),
+            (attachment3, attachment3_label))):
+        if attachment:
+            attachments_list.append((
+                label or _(u'attachment {0}').format(i + 1),
+                attachment))
+    attachments_list.extend(attachments)
+    mime_attachments = [
+            create_attachment(*attachment)
+            for attachment in attachments_list]
 
-    emails = []
-    for email_address in email_addresses:
-        email = mail.EmailMessage(title)
-        email.body = text
-        email.from_email = backend_args['username']
-        email.to = [email_address]
-        if attachment1:
-            email.attach(
-                    smart_str(attachment1_label or _(u'attachment 1')),
-                    attachment1_data)
-        if attachment2:
-            email.attach(
-                    smart_str(attachment2_label or _(u'attachment 2')),
-                    attachment2_data)
-        if attachment3:
-            email.attach(
-                    smart_str(attachment3_label or _(u'attachment 3')),
-                    attachment3_data)
-        emails.append(email)
-
-    for i in range(0, len(emails), 7):
-        connection = mail.get_connection(use_tls=True, **backend_args)
-        connection.send_messages(emails[i:i + 7])
+    if report is not None:
+        email_addresses = (
+                address for address in email_addresses
+                if not report.is_sent(address))
+    messages = generate_messages(
+            email_addresses, title, text, kwargs['username'],
+            mime_attachments)
+    return deliver(
+            messages, report, batch_size, batch_pause, **kwargs)
+
+
+def send_mass_mail_templated(
+        recipients, subject_template, text_template, html_template=None,
+        batch_size=None, batch_pause=None, attachments=(), report=None,
+        **kwargs):
+    """ Sends personalized emails using custom connection.
+
+    Templates are given as Django template sources, which are compiled
+    once and rendered for each recipient while sending. Subject and
+    text are rendered without autoescaping. Delivery is done as in
+    :func:`send_mass_mail`.
+
+    :param recipients: iterable of pairs ``(email_address, context)``.
+    :param html_template: if given, then messages have HTML alternative.
+    :param attachments: list of pairs ``(label, file)`` or triples
+        ``(label, file, mimetype)``.
+    :param report: report of interrupted run; recipients, to whom
+        message was already sent, are skipped.
+    :returns: :class:`DeliveryReport`.
+    """
+
+    mime_attachments = [
+            create_attachment(*attachment)
+            for attachment in attachments]
+
+    if report is not None:
+        recipients = (
+                (address, context) for address, context in recipients
+                if not report.is_sent(address))
+    messages = generate_templated_messages(
+            recipients, Template(subject_template), Template(text_template),
+            kwargs['username'],
+            Template(html_template) if html_template else None,
+            mime_attachments)
+    return deliver(
+            messages, report, batch_size, batch_pause, **kwargs)
@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.contrib import admin
+from django.core.management.base import NoArgsCommand
+
+from nmadb_utils import jobs
+
+
+class Command(NoArgsCommand):
+    """ Runs background export jobs.
+    """
+
+    help = u'Runs background export jobs, scheduled from admin.'
+
+    option_list = NoArgsCommand.option_list + (
+            make_option(
+                '--processes',
+                type='int',
+                default=1,
+                help=u'Number of jobs run in parallel.'),
+            make_option(
+                '--poll-interval',
+                type='float',
+                default=5,
+                help=u'Seconds to wait, when there are no pending jobs.'),
+            make_option(
+                '--once',
+                action='store_true',
+                default=False,
+                help=u'Exit, when there are no pending jobs.'),
+            )
+
+    def handle_noargs(self, **options):
+        admin.autodiscover()
+        jobs.run_worker(
+                processes=options['processes'],
+                poll_interval=options['poll_interval'],
+                once=options['once'])
@@ -1,6 +1,23 @@
+import base64
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
+from nmadb_utils import export
+
+
+EXPORT_JOBS_DIR = getattr(
+        settings, 'NMADB_EXPORT_JOBS_DIR',
+        os.path.join(tempfile.gettempdir(), 'nmadb-export-jobs'))
+
 
 class DownloadSelection(models.Model):
     """ DownloadSelection for download as action in admin.
@@ -43,3 +60,218 @@ class DownloadSelection(models.Model):
 
     def __unicode__(self):
         return unicode(self.title)
+
+    def save(self, *args, **kwargs):
+        """ Validates selection (see :meth:`clean`) before saving.
+
+        :raises django.core.exceptions.ValidationError:
+        """
+        self.full_clean()
+        super(DownloadSelection, self).save(*args, **kwargs)
+
+    def get_model_class(self):
+        """ Returns model class, named in ``model`` field, or ``None``
+        if it is not given or not found.
+
+        Model can be given as ``app_label.ModelName`` or as model name
+        only, if it is unique.
+        """
+        name = self.model.strip()
+        if not name:
+            return None
+        if u'.' in name:
+            return models.get_model(*name.rsplit(u'.', 1))
+        found = [
+                model for model in models.get_models()
+                if model._meta.object_name.lower() == name.lower()]
+        if len(found) == 1:
+            return found[0]
+        return None
+
+    def clean(self):
+        """ Validates query against model.
+        """
+        if not self.model.strip():
+            return
+        model = self.get_model_class()
+        if model is None:
+            raise ValidationError({'model': [_(u'Model not found.')]})
+        errors = []
+        for i, (caption, parts) in enumerate(
+                export.parse_sheet_mapping(self.query)):
+            error = export.validate_field_path(model, parts)
+            if error:
+                errors.append(_(u'Row {0}: {1}').format(i + 1, error))
+        if errors:
+            raise ValidationError({'query': errors})
+
+    def get_sheet_mapping(self):
+        """ Returns parsed query. It is cached per process by primary
+        key and hash of query.
+        """
+        key = (self.pk, hashlib.sha1(self.query.encode('utf-8')).digest())
+        try:
+            return _sheet_mappings[key]
+        except KeyError:
+            mapping = [
+                    (caption, tuple(parts))
+                    for caption, parts in export.parse_sheet_mapping(
+                        self.query)]
+            if self.pk is not None:
+                _sheet_mappings[key] = mapping
+            return mapping
+
+
+_sheet_mappings = {}
+
+
+@receiver(post_save, sender=DownloadSelection)
+@receiver(post_delete, sender=DownloadSelection)
+def invalidate_sheet_mapping(sender, instance, **kwargs):
+    """ Removes cached sheet mappings of download selection.
+    """
+    for key in _sheet_mappings.keys():
+        if key[0] == instance.pk:
+            del _sheet_mappings[key]
+
+
+class ExportJob(models.Model):
+    """ Export of selected objects, which is run in background by
+    ``nmadb_export_worker`` management command.
+    """
+
+    PENDING = u'pending'
+    RUNNING = u'running'
+    DONE = u'done'
+    FAILED = u'failed'
+
+    STATUSES = (
+            (PENDING, _(u'pending')),
+            (RUNNING, _(u'running')),
+            (DONE, _(u'done')),
+            (FAILED, _(u'failed')),
+            )
+
+    model = models.CharField(
+            max_length=100,
+            verbose_name=_(u'model'),
+            help_text=_(u'In form: app_label.ModelName'),
+            )
+
+    writer = models.CharField(
+            max_length=10,
+            verbose_name=_(u'writer'),
+            )
+
+    sheet_mapping = models.TextField(
+            verbose_name=_(u'sheet mapping'),
+            )
+
+    query = models.TextField(
+            verbose_name=_(u'query'),
+            help_text=_(u'Pickled and base64 encoded queryset query.'),
+            )
+
+    status = models.CharField(
+            max_length=10,
+            choices=STATUSES,
+            default=PENDING,
+            db_index=True,
+            verbose_name=_(u'status'),
+            )
+
+    user = models.ForeignKey(
+            settings.AUTH_USER_MODEL,
+            null=True,
+            blank=True,
+            verbose_name=_(u'user'),
+            )
+
+    created = models.DateTimeField(
+            auto_now_add=True,
+            verbose_name=_(u'created'),
+            )
+
+    started = models.DateTimeField(
+            null=True,
+            blank=True,
+            verbose_name=_(u'started'),
+            )
+
+    finished = models.DateTimeField(
+            null=True,
+            blank=True,
+            verbose_name=_(u'finished'),
+            )
+
+    file_name = models.CharField(
+            max_length=255,
+            blank=True,
+            verbose_name=_(u'file name'),
+            )
+
+    content_type = models.CharField(
+            max_length=100,
+            blank=True,
+            verbose_name=_(u'content type'),
+            )
+
+    error = models.TextField(
+            blank=True,
+            verbose_name=_(u'error'),
+            )
+
+    class Meta(object):
+        ordering = [u'-created',]
+        verbose_name = _(u'export job')
+        verbose_name_plural = _(u'export jobs')
+
+    def __unicode__(self):
+        return u'{0} ({1}, {2})'.format(self.model, self.writer, self.status)
+
+    @classmethod
+    def create(cls, queryset, writer_type, sheet_mapping, user=None):
+        """ Creates pending export job of queryset.
+        """
+        opts = queryset.model._meta
+        return cls.objects.create(
+                model=u'{0}.{1}'.format(opts.app_label, opts.object_name),
+                writer=writer_type,
+                sheet_mapping=export.format_sheet_mapping(sheet_mapping),
+                query=base64.b64encode(pickle.dumps(
+                    queryset.query, pickle.HIGHEST_PROTOCOL)),
+                user=user,
+                )
+
+    def get_model(self):
+        """ Returns exported model class.
+        """
+        return models.get_model(*self.model.split(u'.'))
+
+    def get_queryset(self):
+        """ Returns exported queryset.
+        """
+        queryset = self.get_model()._default_manager.all()
+        queryset.query = pickle.loads(base64.b64decode(self.query))
+        return queryset
+
+    def get_sheet_mapping(self):
+        """ Returns parsed sheet mapping.
+        """
+        return export.parse_sheet_mapping(self.sheet_mapping)
+
+    def get_file_path(self):
+        """ Returns path of generated file.
+        """
+        return os.path.join(EXPORT_JOBS_DIR, self.file_name)
+
+
+@receiver(post_delete, sender=ExportJob)
+def remove_export_job_file(sender, instance, **kwargs):
+    """ Removes generated file of deleted export job.
+    """
+    if instance.file_name:
+        try:
+            os.remove(instance.get_file_path())
+        except OSError:
+            pass
@@ -0,0 +1,266 @@
+""" Streaming writer and reader of OpenDocument spreadsheets.
+
+Rows are written into ``content.xml`` one by one, so that memory usage
+does not depend on the number of rows. ``content.xml`` is kept in a
+temporary file, until the document is packed into zip archive.
+
+Rows are read by parsing ``content.xml`` incrementally and discarding
+elements of each row, when the row is read.
+"""
+
+
+import re
+import tempfile
+import zipfile
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+
+MIME_TYPE = 'application/vnd.oasis.opendocument.spreadsheet'
+
+CONTENT_START = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document-content '
+        'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+        'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+        'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+        'office:version="1.2">'
+        '<office:body><office:spreadsheet>')
+CONTENT_END = '</office:spreadsheet></office:body></office:document-content>'
+
+STYLES = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document-styles '
+        'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+        'office:version="1.2"/>')
+
+MANIFEST = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<manifest:manifest '
+        'xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+        'manifest:version="1.2">'
+        '<manifest:file-entry manifest:full-path="/" '
+        'manifest:version="1.2" manifest:media-type="{0}"/>'
+        '<manifest:file-entry manifest:full-path="content.xml" '
+        'manifest:media-type="text/xml"/>'
+        '<manifest:file-entry manifest:full-path="styles.xml" '
+        'manifest:media-type="text/xml"/>'
+        '</manifest:manifest>').format(MIME_TYPE)
+
+OFFICE_NS = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+TABLE_NS = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+TEXT_NS = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+TABLE = TABLE_NS + 'table'
+TABLE_ROW = TABLE_NS + 'table-row'
+TABLE_CELLS = (TABLE_NS + 'table-cell', TABLE_NS + 'covered-table-cell')
+PARAGRAPHS = (TEXT_NS + 'p', TEXT_NS + 'h')
+
+# Cells of these types are read from value attribute instead of the
+# displayed (formatted) text.
+VALUE_ATTRIBUTES = {
+        'float': OFFICE_NS + 'value',
+        'percentage': OFFICE_NS + 'value',
+        'currency': OFFICE_NS + 'value',
+        'date': OFFICE_NS + 'date-value',
+        }
+
+# Characters, which are not allowed in XML documents.
+INVALID_CHARACTERS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def format_cell(value):
+    """ Returns XML of string cell with value.
+    """
+    if value is None:
+        return '<table:table-cell/>'
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    value = INVALID_CHARACTERS.sub(u'', value)
+    paragraphs = u''.join(
+            u'<text:p>{0}</text:p>'.format(escape(line))
+            for line in value.split(u'\n'))
+    return (
+            u'<table:table-cell office:value-type="string">{0}'
+            u'</table:table-cell>').format(paragraphs).encode('utf-8')
+
+
+class ODSWriter(object):
+    """ Writer, which writes spreadsheet sheet by sheet and row by row.
+
+    Usage::
+
+        writer = ODSWriter()
+        try:
+            writer.write_sheet(u'Data', rows)
+            writer.save(output)
+        finally:
+            writer.close()
+
+    """
+
+    mime_type = MIME_TYPE
+    file_extensions = ['ods']
+
+    def __init__(self):
+        self.content = tempfile.NamedTemporaryFile(suffix='.xml')
+        self.content.write(CONTENT_START)
+        self.in_sheet = False
+
+    def start_sheet(self, name):
+        """ Starts new sheet.
+        """
+        if self.in_sheet:
+            self.end_sheet()
+        self.content.write('<table:table table:name={0}>'.format(
+            quoteattr(name).encode('utf-8')))
+        self.in_sheet = True
+
+    def write_row(self, row):
+        """ Writes row (list of values) into current sheet.
+        """
+        self.content.write('<table:table-row>{0}</table:table-row>'.format(
+            ''.join(format_cell(value) for value in row)))
+
+    def end_sheet(self):
+        """ Finishes current sheet.
+        """
+        self.content.write('</table:table>')
+        self.in_sheet = False
+
+    def write_sheet(self, name, rows):
+        """ Writes sheet with rows.
+        """
+        self.start_sheet(name)
+        for row in rows:
+            self.write_row(row)
+        self.end_sheet()
+
+    def save(self, output):
+        """ Packs spreadsheet into seekable file-like object.
+        """
+        if self.in_sheet:
+            self.end_sheet()
+        self.content.write(CONTENT_END)
+        self.content.flush()
+        archive = zipfile.ZipFile(
+                output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        # Mimetype has to be the first and not compressed.
+        archive.writestr(
+                zipfile.ZipInfo('mimetype'), MIME_TYPE, zipfile.ZIP_STORED)
+        archive.writestr('META-INF/manifest.xml', MANIFEST)
+        archive.writestr('styles.xml', STYLES)
+        # Python 2 zipfile can add big files without reading them into
+        # memory only from disk.
+        archive.write(self.content.name, 'content.xml')
+        archive.close()
+
+    def close(self):
+        """ Removes temporary data.
+        """
+        self.content.close()
+
+
+
+def get_element_text(element):
+    """ Returns text of paragraph or span element.
+    """
+    parts = [element.text or u'']
+    for child in element:
+        if child.tag == TEXT_NS + 's':
+            parts.append(u' ' * int(child.get(TEXT_NS + 'c', 1)))
+        elif child.tag == TEXT_NS + 'tab':
+            parts.append(u'\t')
+        elif child.tag == TEXT_NS + 'line-break':
+            parts.append(u'\n')
+        else:
+            parts.append(get_element_text(child))
+        parts.append(child.tail or u'')
+    return u''.join(parts)
+
+
+def get_cell_value(element):
+    """ Returns value of cell as unicode string.
+    """
+    attribute = VALUE_ATTRIBUTES.get(element.get(OFFICE_NS + 'value-type'))
+    if attribute is not None and element.get(attribute) is not None:
+        return unicode(element.get(attribute))
+    return u'\n'.join(
+            get_element_text(paragraph)
+            for paragraph in element
+            if paragraph.tag in PARAGRAPHS)
+
+
+def is_spreadsheet(input):
+    """ Checks if seekable file-like object is zip archive, which
+    contains ``content.xml``.
+    """
+    try:
+        if not zipfile.is_zipfile(input):
+            return False
+        input.seek(0)
+        archive = zipfile.ZipFile(input)
+        try:
+            return 'content.xml' in archive.namelist()
+        finally:
+            archive.close()
+    except (IOError, zipfile.BadZipfile):
+        return False
+    finally:
+        input.seek(0)
+
+
+def read_rows(input):
+    """ Yields pairs ``(sheet_name, values)`` for each row of spreadsheet
+    in seekable file-like object.
+
+    Repeated cells and rows are expanded, except empty cells at the end
+    of row and empty rows at the end of sheet (spreadsheet applications
+    use them to fill the whole sheet).
+    """
+    archive = zipfile.ZipFile(input)
+    content = archive.open('content.xml')
+    try:
+        sheet_name = None
+        values = []
+        empty_cells = 0
+        empty_rows = 0
+        parents = []
+        for event, element in ElementTree.iterparse(
+                content, ('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                if element.tag == TABLE:
+                    sheet_name = unicode(element.get(TABLE_NS + 'name', u''))
+                    empty_rows = 0
+                elif element.tag == TABLE_ROW:
+                    values = []
+                    empty_cells = 0
+                continue
+            parents.pop()
+            if element.tag in TABLE_CELLS and parents[-1].tag == TABLE_ROW:
+                repeated = int(element.get(
+                    TABLE_NS + 'number-columns-repeated', 1))
+                value = get_cell_value(element)
+                if value:
+                    values.extend([u''] * empty_cells)
+                    values.extend([value] * repeated)
+                    empty_cells = 0
+                else:
+                    empty_cells += repeated
+            elif element.tag == TABLE_ROW:
+                repeated = int(element.get(
+                    TABLE_NS + 'number-rows-repeated', 1))
+                if values:
+                    for i in xrange(empty_rows):
+                        yield sheet_name, []
+                    for i in xrange(repeated):
+                        yield sheet_name, list(values)
+                    empty_rows = 0
+                else:
+                    empty_rows += repeated
+                # Parsed rows are not kept in memory.
+                parents[-1].remove(element)
+    finally:
+        content.close()
+        archive.close()
@@ -1,23 +1,380 @@
 import cStringIO as StringIO
+import datetime
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import zipfile
+from pyPdf import PdfFileReader, PdfFileWriter
 from xhtml2pdf import pisa
+import xhtml2pdf.default
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.db import models
+from django.template import loader
 from django.template.loader import get_template
-from django.template import Context
-from django.http import HttpResponse
+from django.template import Context, TemplateDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils import translation
 from cgi import escape
 
+from nmadb_utils import cache
+from nmadb_utils import export
 
-def render_to_pdf(template_src, context_dict):
+
+# If true, then compiled templates are kept in memory (template
+# changes are seen only after restart).
+PDF_CACHE_TEMPLATES = getattr(
+        settings, 'NMADB_PDF_CACHE_TEMPLATES', not settings.DEBUG)
+
+# Fonts, which are registered once per process, so that templates can
+# use them without ``@font-face`` rules: dictionary mapping font name
+# to TrueType font file path.
+PDF_FONTS = getattr(settings, 'NMADB_PDF_FONTS', {})
+
+# Generated PDF is kept in memory while it is smaller than this number
+# of bytes, and spooled to temporary file otherwise.
+PDF_SPOOL_SIZE = getattr(settings, 'NMADB_PDF_SPOOL_SIZE', 1024 * 1024)
+
+# Number of worker processes used to render batches of documents. If
+# ``None``, then number of CPUs is used.
+PDF_PROCESSES = getattr(settings, 'NMADB_PDF_PROCESSES', None)
+
+# Cache of documents rendered by :func:`render_to_pdf`, keyed by
+# template source and context. Cache is disabled if its size is 0.
+PDF_CACHE_DIR = getattr(
+        settings, 'NMADB_PDF_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'nmadb-pdf-cache'))
+PDF_CACHE_SIZE = getattr(settings, 'NMADB_PDF_CACHE_SIZE', 0)
+PDF_CACHE_MAX_AGE = getattr(settings, 'NMADB_PDF_CACHE_MAX_AGE', 24 * 3600)
+
+pdf_cache = cache.DiskCache(PDF_CACHE_DIR, PDF_CACHE_SIZE, PDF_CACHE_MAX_AGE)
+
+
+class PdfRenderError(Exception):
+    """ Raised when some document of batch cannot be converted to PDF.
+    """
+
+
+_templates = {}
+_template_hashes = {}
+_fonts_registered = False
+
+
+def load_template(template_src):
+    """ Returns compiled template.
+    """
+    if not PDF_CACHE_TEMPLATES:
+        return get_template(template_src)
+    try:
+        return _templates[template_src]
+    except KeyError:
+        template = _templates[template_src] = get_template(template_src)
+        return template
+
+
+def register_fonts():
+    """ Registers fonts from ``NMADB_PDF_FONTS`` setting, if they are
+    not registered yet.
+    """
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    for name, path in PDF_FONTS.items():
+        pdfmetrics.registerFont(TTFont(name, path))
+        xhtml2pdf.default.DEFAULT_FONT[name.lower()] = name
+    _fonts_registered = True
+
+
+def render_html(template_src, context_dict):
+    """ Renders template to HTML.
+    """
+    return load_template(template_src).render(Context(context_dict))
+
+
+def write_pdf(html, output):
+    """ Converts HTML to PDF and writes it into file-like object.
+
+    :returns: ``True`` if conversion succeeded.
+    """
+    register_fonts()
+    pdf = pisa.pisaDocument(StringIO.StringIO(html.encode("UTF-8")), output)
+    return not pdf.err
+
+
+def pdf_file_response(pdf_file, streaming=False):
+    """ Returns response with PDF from file, positioned at the end of
+    data.
+
+    :param streaming: if true, then :class:`StreamingHttpResponse`,
+        which reads file while it is sent, is returned; otherwise file
+        is read into :class:`HttpResponse` and closed.
+    """
+    size = pdf_file.tell()
+    pdf_file.seek(0)
+    if streaming:
+        response = StreamingHttpResponse(
+                FileWrapper(pdf_file), content_type='application/pdf')
+    else:
+        response = HttpResponse(
+                pdf_file.read(), content_type='application/pdf')
+        pdf_file.close()
+    response['Content-Length'] = size
+    return response
+
+
+def find_template_source(template_src, loaders=None):
+    """ Returns source of template.
+    """
+    if loaders is None:
+        load_template(template_src)
+        loaders = loader.template_source_loaders
+    for template_loader in loaders:
+        if hasattr(template_loader, 'loaders'):
+            try:
+                return find_template_source(
+                        template_src, template_loader.loaders)
+            except TemplateDoesNotExist:
+                continue
+        try:
+            return template_loader.load_template_source(template_src)[0]
+        except TemplateDoesNotExist:
+            pass
+    raise TemplateDoesNotExist(template_src)
+
+
+def get_template_hash(template_src):
+    """ Returns hash of template source. It is cached together with
+    compiled template.
+    """
+    try:
+        return _template_hashes[template_src]
+    except KeyError:
+        source = find_template_source(template_src)
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if PDF_CACHE_TEMPLATES:
+            _template_hashes[template_src] = digest
+        return digest
+
+
+def canonical_value(value):
+    """ Returns representation of context value, which is equal for
+    equal values.
+
+    Model instances are represented by their concrete field values,
+    so changes of related objects are not seen.
+    """
+    if isinstance(value, models.Model):
+        return (
+                value._meta.app_label, value._meta.object_name,
+                [(field.attname, canonical_value(getattr(
+                    value, field.attname)))
+                 for field in value._meta.fields])
+    if isinstance(value, dict):
+        return sorted(
+                (canonical_value(key), canonical_value(item))
+                for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical_value(item) for item in value)
+    if isinstance(value, (list, tuple, models.query.QuerySet)):
+        return [canonical_value(item) for item in value]
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return repr(value)
+
+
+def get_template_prefix(template_src):
+    """ Returns prefix of keys of cached documents rendered from
+    template.
+    """
+    return hashlib.sha1(template_src.encode('utf-8')).hexdigest()[:8]
+
+
+def get_pdf_cache_key(template_src, context_dict):
+    """ Returns key, under which document is cached. Active language
+    and time zone are part of key, because template output (for
+    example, formatted dates) depends on them.
+    """
+    return u'{0}-{1}'.format(
+            get_template_prefix(template_src),
+            cache.make_key(
+                get_template_hash(template_src),
+                canonical_value(context_dict),
+                translation.get_language(),
+                timezone.get_current_timezone_name()))
+
+
+def invalidate_pdf_cache(template_src=None):
+    """ Removes cached documents rendered from template or, if template
+    is not given, all cached documents.
+
+    Has to be called, when template or templates it includes are
+    changed.
+    """
+    if template_src is None:
+        _template_hashes.clear()
+        _templates.clear()
+        pdf_cache.clear()
+    else:
+        _template_hashes.pop(template_src, None)
+        _templates.pop(template_src, None)
+        pdf_cache.clear(get_template_prefix(template_src))
+
+
+def render_cached_pdf(template_src, context_dict):
+    """ Renders template to PDF, using documents cache.
+
+    :returns: opened file with PDF or ``None`` if conversion failed.
+    """
+    key = get_pdf_cache_key(template_src, context_dict)
+    cached = pdf_cache.open(key)
+    if cached is None:
+        html = render_html(template_src, context_dict)
+        entry = pdf_cache.create(key)
+        if not write_pdf(html, entry):
+            entry.discard()
+            return None
+        cached = entry.commit(reopen=True)
+    return cached
+
+
+def render_to_pdf(template_src, context_dict, use_cache=None,
+                  streaming=False):
     """ Render to pdf helper.
 
     Taken from http://stackoverflow.com/a/1377652.
+
+    :param use_cache: if true, then rendered documents are cached;
+        by default cache is used if ``NMADB_PDF_CACHE_SIZE`` is set.
+    :param streaming: if true, then :class:`StreamingHttpResponse` is
+        returned, which sends document from temporary file or cache
+        without reading it into memory. Admin actions can return it
+        only with :class:`nmadb_utils.admin.StreamingActionsMixin`.
+    """
+    if use_cache is None:
+        use_cache = bool(PDF_CACHE_SIZE)
+    if use_cache:
+        cached = render_cached_pdf(template_src, context_dict)
+        if cached is not None:
+            cached.seek(0, os.SEEK_END)
+            return pdf_file_response(cached, streaming)
+    html = render_html(template_src, context_dict)
+    result = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    if write_pdf(html, result):
+        return pdf_file_response(result, streaming)
+    result.close()
+    return HttpResponse('We had some errors<pre>%s</pre>' % escape(html))
+
+
+def render_pdf_data(template_src, context_dict):
+    """ Renders template to PDF.
+
+    :returns: PDF data.
     """
-    template = get_template(template_src)
-    context = Context(context_dict)
-    html  = template.render(context)
+    html = render_html(template_src, context_dict)
     result = StringIO.StringIO()
+    if not write_pdf(html, result):
+        raise PdfRenderError(template_src)
+    return result.getvalue()
 
-    pdf = pisa.pisaDocument(
-            StringIO.StringIO(html.encode("UTF-8")), result)
-    if not pdf.err:
-        return HttpResponse(result.getvalue(), mimetype='application/pdf')
-    return HttpResponse('We had some errors<pre>%s</pre>' % escape(html))
+
+def render_pdf_task(args):
+    """ Renders one document of batch in worker process.
+    """
+    template_src, context_dict = args
+    return render_pdf_data(template_src, context_dict)
+
+
+def iterate_batch(template_src, contexts, processes=None, progress=None):
+    """ Yields PDF data of documents rendered from template with each
+    context, in the same order as contexts.
+
+    :param processes: number of worker processes; by default
+        ``NMADB_PDF_PROCESSES``. Contexts are pickled to be sent to
+        workers.
+    :param progress: function, which is called with number of rendered
+        documents and total number of documents after each document.
+    """
+    contexts = list(contexts)
+    if processes is None:
+        processes = PDF_PROCESSES or multiprocessing.cpu_count()
+    processes = min(processes, len(contexts))
+    tasks = [(template_src, context_dict) for context_dict in contexts]
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(
+                processes, export.reset_worker_connections)
+        documents = pool.imap(render_pdf_task, tasks)
+    else:
+        documents = (render_pdf_task(task) for task in tasks)
+    try:
+        for i, data in enumerate(documents):
+            if progress is not None:
+                progress(i + 1, len(tasks))
+            yield data
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def merge_pdfs(documents, output):
+    """ Writes pages of all documents (PDF data) as one document.
+    """
+    writer = PdfFileWriter()
+    for data in documents:
+        reader = PdfFileReader(StringIO.StringIO(data))
+        for i in range(reader.getNumPages()):
+            writer.addPage(reader.getPage(i))
+    writer.write(output)
+
+
+def zip_pdfs(documents, output, file_names=None):
+    """ Writes documents (PDF data) into zip archive.
+
+    :param file_names: names of documents in archive; by default
+        documents are numbered.
+    """
+    archive = zipfile.ZipFile(
+            output, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    for i, data in enumerate(documents):
+        if file_names is None:
+            name = '{0:04d}.pdf'.format(i + 1)
+        else:
+            name = file_names[i]
+        archive.writestr(name, data)
+    archive.close()
+
+
+def render_batch_to_pdf(template_src, contexts, processes=None,
+                        progress=None):
+    """ Renders template with each context in pool of worker processes
+    and returns streaming response with all documents merged into one.
+
+    See :func:`iterate_batch` for parameters.
+    """
+    result = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    merge_pdfs(
+            iterate_batch(template_src, contexts, processes, progress),
+            result)
+    return pdf_file_response(result, streaming=True)
+
+
+def render_batch_to_zip(template_src, contexts, file_names=None,
+                        processes=None, progress=None):
+    """ Renders template with each context in pool of worker processes
+    and returns streaming response with zip archive of documents.
+
+    See :func:`iterate_batch` and :func:`zip_pdfs` for parameters.
+    """
+    result = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    zip_pdfs(
+            iterate_batch(template_src, contexts, processes, progress),
+            result, file_names)
+    response = pdf_file_response(result, streaming=True)
+    response['Content-Type'] = 'application/zip'
+    response['Content-Disposition'] = 'attachment; filename=documents.zip'
+    return response
@@ -0,0 +1,54 @@
+""" Signed tokens, which describe objects selected for admin action.
+
+Intermediate action pages (for example, download selection form) pass
+the token instead of the list of selected primary keys. If all objects
+of the changelist were selected, then token contains only changelist
+filters, so its size does not depend on the number of objects.
+"""
+
+
+from django.core import signing
+from django.utils.encoding import force_text
+
+
+SALT = 'nmadb_utils.selection'
+
+
+def make_token(request, queryset):
+    """ Returns token, describing queryset, which was passed to admin
+    action.
+    """
+    opts = queryset.model._meta
+    data = {'model': u'{0}.{1}'.format(opts.app_label, opts.object_name)}
+    if request.POST.get('select_across') == u'1':
+        data['filters'] = request.GET.urlencode()
+    else:
+        data['pks'] = [
+                force_text(pk)
+                for pk in queryset.values_list('pk', flat=True)]
+    return signing.dumps(data, salt=SALT, compress=True)
+
+
+def load_token(token):
+    """ Returns data of token.
+
+    :raises django.core.signing.BadSignature: if token is not valid.
+    """
+    return signing.loads(token, salt=SALT)
+
+
+def filter_queryset(request, queryset, data):
+    """ Returns part of changelist queryset, described by token data.
+
+    :raises ValueError: if token was created for other model or other
+        changelist filters.
+    """
+    opts = queryset.model._meta
+    if data.get('model') != u'{0}.{1}'.format(
+            opts.app_label, opts.object_name):
+        raise ValueError(u'Token was created for other model.')
+    if 'pks' in data:
+        return queryset.filter(pk__in=data['pks'])
+    if data.get('filters') != request.GET.urlencode():
+        raise ValueError(u'Token was created for other filters.')
+    return queryset
@@ -1,6 +1,10 @@
 from django import template
+from django.core.urlresolvers import (
+        get_resolver, get_script_prefix, get_urlconf)
+from django.template.loader import render_to_string
+from django.utils.translation import get_language
 
-from nmadb_utils.actions import Action
+from nmadb_utils.actions import Action, get_actions, group_actions
 
 
 class ActionListNode(template.Node):
@@ -14,13 +18,14 @@ class ActionListNode(template.Node):
         return "<GetNMADBActionList Node>"
 
     def render(self, context):
-        context[self.varname] = Action.actions
+        context[self.varname] = get_actions(context.get('user'))
         return ''
 
 
 class DoGetActionList(object):
     """
-    Populates a template variable with the NMADB actions list.
+    Populates a template variable with the list of NMADB actions, which
+    are available to the user.
 
     Usage::
 
@@ -47,6 +52,59 @@ class DoGetActionList(object):
         return ActionListNode(varname=tokens[2])
 
 
+class ActionMenuNode(template.Node):
+    """ Rendered NMADB actions menu.
+
+    Rendered menus are cached per process by registry version, language,
+    URL resolver (resolvers are recreated when URLconf is reloaded) and
+    the set of actions available to the user.
+    """
+
+    template_name = 'admin/nmadb_action_menu.html'
+
+    cache = {}
+    cache_version = None
+
+    def __repr__(self):
+        return "<NMADBActionMenu Node>"
+
+    def render(self, context):
+        if ActionMenuNode.cache_version != Action.version:
+            ActionMenuNode.cache = {}
+            ActionMenuNode.cache_version = Action.version
+        actions = get_actions(context.get('user'))
+        key = (
+                get_language(), get_resolver(get_urlconf()),
+                get_script_prefix(),
+                tuple(action.gid for action in actions))
+        try:
+            return self.cache[key]
+        except KeyError:
+            menu = self.cache[key] = render_to_string(
+                    self.template_name,
+                    {
+                        'actions': actions,
+                        'action_groups': group_actions(actions),
+                        })
+            return menu
+
+
+def do_action_menu(parser, token):
+    """
+    Renders menu of NMADB actions, which are available to the user.
+
+    Usage::
+
+        {% nmadb_action_menu %}
+
+    """
+    if len(token.contents.split()) != 1:
+        raise template.TemplateSyntaxError(
+                "'nmadb_action_menu' statement takes no arguments")
+    return ActionMenuNode()
+
+
 register = template.Library()
 register.tag(
     'get_nmadb_action_list', DoGetActionList('get_nmadb_action_list'))
+register.tag('nmadb_action_menu', do_action_menu)
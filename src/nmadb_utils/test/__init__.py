@@ -0,0 +1,23 @@
+""" Tests of nmadb_utils.
+
+Tests are run with :mod:`nmadb_utils.test.settings`, which use
+temporary SQLite database with models from :mod:`nmadb_utils.test.models`.
+"""
+
+
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nmadb_utils.test.settings')
+
+
+_database_created = False
+
+
+def setup_database():
+    """ Creates tables of installed applications once per process.
+    """
+    global _database_created
+    if not _database_created:
+        from django.core.management import call_command
+        call_command('syncdb', interactive=False, verbosity=0)
+        _database_created = True
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+
+""" Tests of NMADB actions and their menu.
+"""
+
+
+import unittest
+
+from django.conf.urls import patterns, url
+from django.http import HttpResponse
+
+import nmadb_utils.test # pylint: disable=W0611
+
+
+def view(request):
+    """ Dummy action view.
+    """
+    return HttpResponse()
+
+
+urlpatterns = patterns('', url(r'^first/$', view, name='test-action'))
+
+
+class ActionMenuTest(unittest.TestCase):
+    """ Tests of ``nmadb_action_menu`` template tag.
+    """
+
+    def setUp(self):
+        from django.core import urlresolvers
+        from django.test.utils import override_settings
+        from nmadb_utils import actions
+        self.urlresolvers = urlresolvers
+        self.actions = actions
+        self.settings = override_settings(
+                ROOT_URLCONF='nmadb_utils.test.actions_test')
+        self.settings.enable()
+        urlresolvers.clear_url_caches()
+        actions.register(
+                'test-action', u'Test action', 'test-action', u'test')
+
+    def tearDown(self):
+        global urlpatterns
+        self.actions.unregister('test-action')
+        urlpatterns = patterns('', url(r'^first/$', view, name='test-action'))
+        self.settings.disable()
+        self.urlresolvers.clear_url_caches()
+
+    def render_menu(self):
+        """ Returns rendered menu of actions.
+        """
+        from django.template import Context, Template
+        return Template(
+                u'{% load nmadb_actions %}{% nmadb_action_menu %}').render(
+                        Context({}))
+
+    def test_urlconf_reload(self):
+        global urlpatterns
+        self.assertIn(u'href="/first/"', self.render_menu())
+        urlpatterns = patterns(
+                '', url(r'^second/$', view, name='test-action'))
+        self.urlresolvers.clear_url_caches()
+        menu = self.render_menu()
+        self.assertIn(u'href="/second/"', menu)
+        self.assertNotIn(u'href="/first/"', menu)
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+
+""" Tests of disk cache.
+"""
+
+
+import shutil
+import tempfile
+import unittest
+
+from nmadb_utils import cache
+
+
+class DiskCacheTest(unittest.TestCase):
+    """ Tests of :class:`nmadb_utils.cache.DiskCache`.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, disk_cache, key, data):
+        """ Stores data and returns reopened entry.
+        """
+        entry = disk_cache.create(key)
+        entry.write(data)
+        return entry.commit(reopen=True)
+
+    def test_reopen_evicted_entry(self):
+        disk_cache = cache.DiskCache(self.directory, 0)
+        stored = self.store(disk_cache, u'key', 'data')
+        self.assertEqual(stored.read(), 'data')
+        stored.close()
+        self.assertEqual(disk_cache.open(u'key'), None)
+        self.assertEqual(disk_cache.get_stats()['entries'], 0)
+
+    def test_evict_least_recently_used(self):
+        disk_cache = cache.DiskCache(self.directory, 8)
+        self.store(disk_cache, u'first', 'abcd').close()
+        self.store(disk_cache, u'second', 'efgh').close()
+        self.assertEqual(disk_cache.open(u'first').read(), 'abcd')
+        self.store(disk_cache, u'third', 'ijkl').close()
+        self.assertEqual(disk_cache.open(u'second'), None)
+        self.assertEqual(disk_cache.open(u'third').read(), 'ijkl')
+        self.assertEqual(disk_cache.evictions, 1)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+
+""" Regression tests, which check that compiled sheet mappings format
+values exactly as :func:`get_field_value` of the first release did, and
+tests of export iteration and cache keys.
+"""
+
+
+from django.test import TestCase
+
+from nmadb_utils.test import setup_database
+
+
+def reference_field_value(obj, parts):
+    """ ``get_field_value`` of the first release.
+    """
+    value = obj
+    try:
+        for i, part in enumerate(parts):
+            value = getattr(value, part)
+            if hasattr(value, '__call__'):
+                value = value()
+            if hasattr(value, '__iter__'):
+                value = u'{{{0}}}'.format(u';'.join(
+                        reference_field_value(item, parts[i+1:])
+                        for item in value
+                        ))
+                break
+        value = unicode(value)
+    except Exception as e:
+        value = u'Error: {0}'.format(e)
+    return value
+
+
+PATHS = [
+        [u'first_name'],
+        [u'birth_date'],
+        [u'id'],
+        [u'school'],
+        [u'school', u'title'],
+        [u'school', u'city'],
+        [u'school', u'id'],
+        [u'mentor_school'],
+        [u'mentor_school', u'title'],
+        [u'school', u'student_set', u'all', u'first_name'],
+        [u'tags', u'all'],
+        [u'tags', u'all', u'name'],
+        [u'grade_set', u'all', u'value'],
+        [u'full_name'],
+        [u'initials'],
+        [u'first_name', u'upper'],
+        [u'missing'],
+        [u'school', u'missing'],
+        ]
+
+
+class CompiledSheetMappingTest(TestCase):
+    """ Compares compiled sheet mappings with reference implementation.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(CompiledSheetMappingTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils import export
+        from nmadb_utils.test.models import create_students
+        self.export = export
+        self.students = create_students(23)
+        self.chunk_size = export.EXPORT_CHUNK_SIZE
+        # Rows are read in several chunks.
+        export.EXPORT_CHUNK_SIZE = 5
+
+    def tearDown(self):
+        self.export.EXPORT_CHUNK_SIZE = self.chunk_size
+
+    def get_reference_rows(self, queryset, sheet_mapping):
+        """ Returns rows, formatted by reference implementation.
+        """
+        return [
+                [reference_field_value(obj, parts)
+                 for caption, parts in sheet_mapping]
+                for obj in self.export.order_stably(queryset)[0]]
+
+    def assert_rows_equal(self, queryset, sheet_mapping):
+        """ Checks both row iteration and formatting of one object.
+        """
+        mapping = self.export.compile_sheet_mapping(
+                queryset.model, sheet_mapping)
+        expected = self.get_reference_rows(queryset, sheet_mapping)
+        self.assertEqual(list(mapping.iterate_rows(queryset)), expected)
+        objects = self.export.order_stably(queryset)[0]
+        self.assertEqual([mapping(obj) for obj in objects], expected)
+
+    def test_field_paths(self):
+        from nmadb_utils.test.models import Student
+        for parts in PATHS:
+            mapping = [(u'Column', parts)]
+            self.assert_rows_equal(Student.objects.all(), mapping)
+
+    def test_get_field_value(self):
+        for parts in PATHS:
+            for student in self.students:
+                self.assertEqual(
+                        self.export.get_field_value(student, parts),
+                        reference_field_value(student, parts))
+
+    def test_values_list_columns(self):
+        from nmadb_utils.test.models import Student
+        mapping = [
+                (u'Name', [u'first_name']),
+                (u'Birth', [u'birth_date']),
+                (u'School', [u'school', u'title']),
+                (u'City', [u'mentor_school', u'city']),
+                ]
+        self.assert_rows_equal(Student.objects.all(), mapping)
+        self.assert_rows_equal(
+                Student.objects.filter(school__title=u'First'), mapping)
+
+    def test_mixed_columns(self):
+        from nmadb_utils.test.models import Student
+        mapping = [(u'Column', parts) for parts in PATHS]
+        self.assert_rows_equal(Student.objects.all(), mapping)
+        self.assert_rows_equal(Student.objects.order_by('-pk'), mapping)
+        self.assert_rows_equal(
+                Student.objects.order_by('first_name', '-pk'), mapping)
+        self.assert_rows_equal(
+                Student.objects.order_by('birth_date'), mapping)
+
+    def test_rows_with_pk(self):
+        from nmadb_utils.test.models import Student
+        mapping = self.export.compile_sheet_mapping(
+                Student, [(u'Name', [u'full_name'])])
+        rows = list(mapping.iterate_rows(
+            Student.objects.all(), with_pk=True))
+        self.assertEqual(
+                [row[0] for row in rows],
+                [student.pk for student in self.export.order_stably(
+                    Student.objects.all())[0]])
+
+
+class IterateQuerysetTest(TestCase):
+    """ Checks that chunked iteration keeps queryset ordering.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(IterateQuerysetTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils.test.models import create_students
+        create_students(17)
+
+    def test_orderings(self):
+        from nmadb_utils import export
+        from nmadb_utils.test.models import Student
+        for ordering in (
+                [], ['-pk'], ['last_name', '-pk'], ['-first_name'],
+                ['birth_date', 'pk'], ['school', '-pk']):
+            queryset = Student.objects.order_by(*ordering)
+            expected = list(export.order_stably(queryset)[0])
+            self.assertEqual(
+                    list(export.iterate_queryset(queryset, chunk_size=4)),
+                    expected)
+            self.assertEqual(
+                    [row[0] for row in export.iterate_queryset(
+                        queryset.values_list('pk', 'first_name'),
+                        chunk_size=4, get_pk=lambda row: row[0])],
+                    [student.pk for student in expected])
+
+
+class ExportKeyTest(TestCase):
+    """ Checks that keys of cached exports change, when data changes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(ExportKeyTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils import export
+        from nmadb_utils.test.models import create_students
+        self.export = export
+        self.max_age = export.export_cache.max_age
+        create_students(5)
+
+    def tearDown(self):
+        self.export.export_cache.max_age = self.max_age
+
+    def get_key(self, queryset):
+        """ Returns key of CSV export of titles or names.
+        """
+        return self.export.get_export_key(
+                queryset, u'CSV', [(u'Name', [u'first_name'])])
+
+    def test_auto_now_model(self):
+        from nmadb_utils.test.models import School
+        self.export.export_cache.max_age = None
+        key = self.get_key(School.objects.all())
+        self.assertNotEqual(key, None)
+        self.assertEqual(self.get_key(School.objects.all()), key)
+        school = School.objects.all()[0]
+        school.title = u'Changed'
+        school.save()
+        self.assertNotEqual(self.get_key(School.objects.all()), key)
+
+    def test_model_without_auto_now(self):
+        from nmadb_utils.test.models import Student
+        self.export.export_cache.max_age = None
+        self.assertEqual(self.get_key(Student.objects.all()), None)
+        self.export.export_cache.max_age = 3600
+        self.assertNotEqual(self.get_key(Student.objects.all()), None)
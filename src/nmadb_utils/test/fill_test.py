@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+
+""" Regression tests, which check that batched lookups of uploaded rows
+give the same results as one ``get`` query per row, and tests of
+reading uploaded CSV files.
+"""
+
+
+import codecs
+import csv
+import StringIO
+import unittest
+
+from django.test import TestCase
+
+from nmadb_utils.test import setup_database
+
+
+SHEET_MAPPING = [
+        (u'Name', [u'full_name']),
+        (u'School', [u'school', u'title']),
+        (u'Birth', [u'birth_date']),
+        ]
+
+
+class KeyResolverTest(TestCase):
+    """ Compares :class:`KeyResolver` with ``get`` query per row.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(KeyResolverTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils import export
+        from nmadb_utils.test.models import Student, create_students
+        create_students(20)
+        self.mapping = export.compile_sheet_mapping(Student, SHEET_MAPPING)
+
+    def get_reference(self, query):
+        """ Returns result of ``get`` query as pair of values and error
+        description.
+        """
+        from nmadb_utils.test.models import Student
+        try:
+            obj = Student.objects.get(**query)
+        except Exception as e:
+            return None, (type(e), unicode(e))
+        return self.mapping(obj), None
+
+    def assert_resolved(self, lookups, queries):
+        """ Checks batched and scanning resolution of queries.
+        """
+        from nmadb_utils import fill
+        from nmadb_utils.test.models import Student
+        resolver = fill.KeyResolver(Student, self.mapping, lookups)
+        expected = [self.get_reference(query) for query in queries]
+        for scan in (False, True):
+            results = [
+                    (values, error and (type(error), unicode(error)))
+                    for values, error in resolver.resolve(queries, scan)]
+            self.assertEqual(results, expected)
+
+    def test_one_key(self):
+        queries = [
+                {u'first_name': value}
+                for value in (u'Name0', u'Name6', u'Missing', u'Name6')]
+        self.assert_resolved([u'first_name'], queries)
+
+    def test_several_keys(self):
+        queries = [
+                {u'first_name': first_name, u'last_name': last_name}
+                for first_name in (u'Name0', u'Name1', u'Name9')
+                for last_name in (u'Last0', u'Last1', u'Last4')]
+        self.assert_resolved([u'first_name', u'last_name'], queries)
+
+    def test_related_key(self):
+        queries = [
+                {u'school__title': u'First', u'first_name': u'Name1'},
+                {u'school__title': u'Second', u'first_name': u'Name0'},
+                {u'school__title': u'Third', u'first_name': u'Name0'},
+                ]
+        self.assert_resolved([u'school__title', u'first_name'], queries)
+
+    def test_converted_values(self):
+        from nmadb_utils.test.models import Student
+        pks = list(Student.objects.values_list('pk', flat=True)[:3])
+        queries = [{u'id': unicode(pk)} for pk in pks] + [
+                {u'id': u'0'}, {u'id': u'not a number'}]
+        self.assert_resolved([u'id'], queries)
+        queries = [
+                {u'birth_date': u'2000-01-02'},
+                {u'birth_date': u'2000-01-27'},
+                {u'birth_date': u'not a date'},
+                ]
+        self.assert_resolved([u'birth_date'], queries)
+
+    def test_case_insensitive_key(self):
+        queries = [
+                {u'nickname': value}
+                for value in (
+                    u'Nick1', u'nick1', u'NICK10', u'nick10', u'Missing')]
+        self.assert_resolved([u'nickname'], queries)
+        queries = [
+                {u'nickname': u'nick2', u'first_name': u'Name2'},
+                {u'nickname': u'NICK3', u'first_name': u'Name1'},
+                ]
+        self.assert_resolved([u'nickname', u'first_name'], queries)
+
+    def test_no_keys(self):
+        self.assert_resolved([], [{}, {}])
+
+    def test_not_batched_lookup(self):
+        queries = [{u'tags__name': u'a'}, {u'tags__name': u'c'}]
+        self.assert_resolved([u'tags__name'], queries)
+
+
+class ReadCSVRowsTest(unittest.TestCase):
+    """ Tests of reading uploaded CSV files.
+    """
+
+    rows = [
+            [u'Vardas', u'Pastabos'],
+            [u'\u0160ar\u016bnas', u'a, "b"\nc'],
+            [u'', u'\t'],
+            ]
+
+    def read(self, data):
+        """ Returns rows of CSV file.
+        """
+        from nmadb_utils import fill
+        return list(fill.read_csv_rows(StringIO.StringIO(data)))
+
+    def encode_rows(self, **kwargs):
+        """ Returns rows encoded as UTF-8 CSV.
+        """
+        output = StringIO.StringIO()
+        writer = csv.writer(output, **kwargs)
+        for row in self.rows:
+            writer.writerow([value.encode('utf-8') for value in row])
+        return output.getvalue()
+
+    def test_utf8(self):
+        data = self.encode_rows()
+        self.assertEqual(self.read(data), self.rows)
+        self.assertEqual(self.read(codecs.BOM_UTF8 + data), self.rows)
+
+    def test_utf16(self):
+        data = self.encode_rows(delimiter='\t').decode('utf-8')
+        self.assertEqual(self.read(data.encode('utf-16')), self.rows)
+        self.assertEqual(
+                self.read(codecs.BOM_UTF16_BE + data.encode('utf-16-be')),
+                self.rows)
+
+    def test_exported_utf16(self):
+        from nmadb_utils import export
+        data = ''.join(export.stream_rows(
+            self.rows, export.UTF16TabRowWriter()))
+        self.assertEqual(self.read(data), self.rows)
+
+    def test_is_csv_readable(self):
+        from nmadb_utils import fill
+        data = self.encode_rows()
+        for readable in (
+                data, codecs.BOM_UTF8 + data,
+                data.decode('utf-8').encode('utf-16'), ''):
+            self.assertTrue(fill.is_csv_readable(StringIO.StringIO(readable)))
+        for unreadable in (
+                data.decode('utf-8').encode('cp1257'),
+                data.decode('utf-8').encode('utf-16-le')):
+            self.assertFalse(
+                    fill.is_csv_readable(StringIO.StringIO(unreadable)))
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+
+""" Tests of background export jobs.
+"""
+
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.contrib import admin
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from nmadb_utils.test import setup_database
+
+
+SHEET_MAPPING = [
+        (u'Name', [u'full_name']),
+        (u'School', [u'school', u'title']),
+        ]
+
+
+class RunJobsTest(TransactionTestCase):
+    """ Tests of :mod:`nmadb_utils.jobs`. Jobs are run in forked worker
+    processes, so data has to be committed.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(RunJobsTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils import models
+        from nmadb_utils.test.models import create_students
+        self.models = models
+        self.jobs_dir = models.EXPORT_JOBS_DIR
+        models.EXPORT_JOBS_DIR = tempfile.mkdtemp()
+        self.students = create_students(30)
+
+    def tearDown(self):
+        shutil.rmtree(self.models.EXPORT_JOBS_DIR)
+        self.models.EXPORT_JOBS_DIR = self.jobs_dir
+        # Other tests expect empty tables.
+        call_command('flush', interactive=False, verbosity=0)
+
+    def register_admin(self, **attributes):
+        """ Registers model admin of students with given attributes.
+        """
+        from nmadb_utils.admin import ModelAdmin
+        from nmadb_utils.test.models import Student
+        model_admin = type('StudentAdmin', (ModelAdmin,), attributes)
+        admin.site.register(Student, model_admin)
+        self.addCleanup(admin.site.unregister, Student)
+
+    def create_job(self, writer=u'CSV'):
+        """ Creates pending export job of all students.
+        """
+        from nmadb_utils.test.models import Student
+        return self.models.ExportJob.create(
+                Student.objects.all(), writer, SHEET_MAPPING)
+
+    def read_result(self, job):
+        """ Returns generated file of finished job.
+        """
+        job = self.models.ExportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, self.models.ExportJob.DONE, job.error)
+        with open(job.get_file_path(), 'rb') as result:
+            return result.read()
+
+    def test_parallel_export_in_job_workers(self):
+        from nmadb_utils import jobs
+        # Without registered model admin rows are formatted serially.
+        job = self.create_job()
+        jobs.run_jobs([job.pk])
+        expected = self.read_result(job)
+        self.register_admin(
+                download_processes=2, download_parallel_min_rows=1)
+        job_pks = [self.create_job().pk for i in range(3)]
+        self.assertEqual(jobs.run_jobs(job_pks, processes=2), 3)
+        for job in self.models.ExportJob.objects.filter(pk__in=job_pks):
+            self.assertEqual(self.read_result(job), expected)
+
+    def test_claim_job(self):
+        from nmadb_utils import jobs
+        job = self.create_job()
+        claimed = jobs.claim_job(job.pk)
+        self.assertEqual(claimed.status, self.models.ExportJob.RUNNING)
+        self.assertNotEqual(claimed.started, None)
+        self.assertEqual(jobs.claim_job(job.pk), None)
+        self.assertFalse(jobs.run_job(job.pk))
+
+    def test_failed_job(self):
+        from nmadb_utils import jobs
+        job = self.create_job()
+        self.models.ExportJob.objects.filter(pk=job.pk).update(
+                model=u'test.Missing')
+        self.assertEqual(jobs.run_jobs([job.pk]), 1)
+        job = self.models.ExportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, self.models.ExportJob.FAILED)
+        self.assertTrue(job.error)
+        self.assertEqual(os.listdir(self.models.EXPORT_JOBS_DIR), [])
+
+    def test_stale_jobs(self):
+        from nmadb_utils import jobs
+        stale = jobs.claim_job(self.create_job().pk)
+        recent = jobs.claim_job(self.create_job().pk)
+        self.models.ExportJob.objects.filter(pk=stale.pk).update(
+                started=timezone.now() - datetime.timedelta(
+                    seconds=jobs.EXPORT_JOBS_TIMEOUT + 60))
+        open(jobs.get_temp_path(stale.pk), 'wb').close()
+        self.assertEqual(jobs.fail_stale_jobs(), 1)
+        stale = self.models.ExportJob.objects.get(pk=stale.pk)
+        self.assertEqual(stale.status, self.models.ExportJob.FAILED)
+        self.assertFalse(os.path.exists(jobs.get_temp_path(stale.pk)))
+        self.assertEqual(
+                self.models.ExportJob.objects.get(pk=recent.pk).status,
+                self.models.ExportJob.RUNNING)
+
+    def test_delete_job_files(self):
+        from nmadb_utils import jobs
+        expired, kept = self.create_job(), self.create_job()
+        jobs.run_jobs([expired.pk, kept.pk])
+        expired = self.models.ExportJob.objects.get(pk=expired.pk)
+        kept = self.models.ExportJob.objects.get(pk=kept.pk)
+        self.models.ExportJob.objects.filter(pk=expired.pk).update(
+                finished=timezone.now() - datetime.timedelta(
+                    seconds=jobs.EXPORT_JOBS_MAX_AGE + 60))
+        jobs.delete_expired_jobs()
+        self.assertFalse(self.models.ExportJob.objects.filter(
+            pk=expired.pk).exists())
+        self.assertFalse(os.path.exists(expired.get_file_path()))
+        self.assertTrue(os.path.exists(kept.get_file_path()))
+        kept.delete()
+        self.assertEqual(os.listdir(self.models.EXPORT_JOBS_DIR), [])
+
+    def test_admin_shows_own_jobs(self):
+        from django.contrib.auth.models import User
+        from nmadb_utils.admin import ExportJobAdmin
+        owner = User.objects.create_user(u'owner', u'owner@example.com')
+        other = User.objects.create_user(u'other', u'other@example.com')
+        superuser = User.objects.create_superuser(
+                u'admin', u'admin@example.com', u'admin')
+        job = self.create_job()
+        self.models.ExportJob.objects.filter(pk=job.pk).update(user=owner)
+        model_admin = ExportJobAdmin(self.models.ExportJob, admin.site)
+        for user, count in ((owner, 1), (other, 0), (superuser, 1)):
+            request = RequestFactory().get('/')
+            request.user = user
+            self.assertEqual(model_admin.queryset(request).count(), count)
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+
+""" Tests of mass mail delivery: retries, reconnects and resuming.
+"""
+
+
+import json
+import smtplib
+import threading
+import unittest
+
+from django.core.mail.backends.base import BaseEmailBackend
+
+import nmadb_utils.test # pylint: disable=W0611
+
+
+BACKEND = 'nmadb_utils.test.mail_test.ScriptedBackend'
+
+
+class ScriptedBackend(BaseEmailBackend):
+    """ Email backend, which fails sending to recipients with errors
+    from :attr:`failures` and remembers sent messages.
+    """
+
+    # Dictionary mapping recipient address to list of errors, which are
+    # raised (one per attempt) before message is sent.
+    failures = {}
+    sent = []
+    lock = threading.Lock()
+
+    def send_messages(self, email_messages):
+        with self.lock:
+            for message in email_messages:
+                for address in message.recipients():
+                    errors = self.failures.get(address)
+                    if errors:
+                        raise errors.pop(0)
+                self.sent.extend(message.recipients())
+        return len(email_messages)
+
+
+def disconnected():
+    """ Returns error, raised when server closes connection.
+    """
+    return smtplib.SMTPServerDisconnected(u'Connection unexpectedly closed')
+
+
+def refused(code):
+    """ Returns error, raised when server rejects recipient.
+    """
+    return smtplib.SMTPRecipientsRefused(
+            {'a@example.com': (code, 'Rejected')})
+
+
+class FakeConnection(object):
+    """ Connection, which raises given errors before sending.
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.attempts = 0
+
+    def send(self, message):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 100
+
+
+class SendMessageTest(unittest.TestCase):
+    """ Tests of :func:`nmadb_utils.mail.send_message`.
+    """
+
+    def setUp(self):
+        from django.core import mail as django_mail
+        from nmadb_utils import mail
+        self.mail = mail
+        self.message = django_mail.EmailMessage(
+                u'Subject', u'Text', u'from@example.com',
+                [u'a@example.com'])
+        self.delays = []
+        self.sleep = mail.time.sleep
+        mail.time.sleep = self.delays.append
+
+    def tearDown(self):
+        self.mail.time.sleep = self.sleep
+
+    def send(self, errors, retries=2):
+        """ Sends message through fake connection and returns its
+        result.
+        """
+        connection = FakeConnection(errors)
+        report = self.mail.DeliveryReport()
+        sent = self.mail.send_message(
+                connection, self.message, report, retries=retries,
+                retry_delay=1)
+        result = report.results[u'a@example.com']
+        self.assertEqual(
+                sent, result.status == self.mail.RecipientResult.SENT)
+        return connection, result
+
+    def test_retry_temporary_failures(self):
+        connection, result = self.send([disconnected(), refused(451)])
+        self.assertEqual(result.status, self.mail.RecipientResult.SENT)
+        self.assertEqual(result.retries, 2)
+        self.assertEqual(result.size, 100)
+        self.assertEqual(connection.attempts, 3)
+        self.assertEqual(self.delays, [1, 2])
+
+    def test_give_up_after_retries(self):
+        connection, result = self.send([refused(450)] * 3)
+        self.assertEqual(result.status, self.mail.RecipientResult.FAILED)
+        self.assertEqual(result.code, 450)
+        self.assertEqual(result.retries, 2)
+        self.assertEqual(connection.attempts, 3)
+
+    def test_permanent_failure(self):
+        connection, result = self.send([refused(550)])
+        self.assertEqual(result.status, self.mail.RecipientResult.FAILED)
+        self.assertEqual(result.code, 550)
+        self.assertEqual(result.retries, 0)
+        self.assertEqual(connection.attempts, 1)
+        self.assertEqual(self.delays, [])
+
+
+class DeliveryTest(unittest.TestCase):
+    """ Tests of reconnecting and resuming delivery with
+    :class:`ScriptedBackend`.
+    """
+
+    def setUp(self):
+        from nmadb_utils import mail
+        self.mail = mail
+        ScriptedBackend.failures = {}
+        ScriptedBackend.sent = []
+
+    def test_reconnect(self):
+        connection = self.mail.MailConnection(
+                reconnect_attempts=1, backend=BACKEND)
+        message = self.mail.mail.EmailMessage(
+                u'Subject', u'Text', u'from@example.com', [u'a@example.com'])
+        ScriptedBackend.failures[u'a@example.com'] = [disconnected()]
+        connection.send(message)
+        self.assertEqual(connection.connects, 2)
+        self.assertEqual(ScriptedBackend.sent, [u'a@example.com'])
+        ScriptedBackend.failures[u'a@example.com'] = [disconnected()] * 2
+        self.assertRaises(
+                smtplib.SMTPServerDisconnected, connection.send, message)
+        # The last attempt is not followed by reconnect.
+        self.assertEqual(connection.connects, 3)
+
+    def check_resume(self, workers):
+        """ Checks that resumed delivery sends messages only to
+        recipients, which failed in the first run.
+        """
+        addresses = [u'{0}@example.com'.format(i) for i in range(6)]
+        ScriptedBackend.failures = {
+                addresses[1]: [refused(550)],
+                addresses[4]: [refused(450), refused(450)],
+                }
+        report = self.mail.send_mass_mail(
+                addresses, u'Subject', u'Text', username=u'from@example.com',
+                backend=BACKEND, workers=workers, retries=1, retry_delay=0)
+        self.assertEqual(report.messages_sent, 4)
+        self.assertEqual(
+                sorted(result.address for result in report.get_failed()),
+                [addresses[1], addresses[4]])
+        # Pool opens connections only when all are busy.
+        self.assertTrue(1 <= report.connections <= workers)
+
+        data = json.loads(json.dumps(report.as_dict()))
+        report = self.mail.DeliveryReport.from_dict(data)
+        ScriptedBackend.sent = []
+        report = self.mail.send_mass_mail(
+                addresses, u'Subject', u'Text', username=u'from@example.com',
+                backend=BACKEND, workers=workers, report=report, retries=1,
+                retry_delay=0)
+        self.assertEqual(
+                sorted(ScriptedBackend.sent), [addresses[1], addresses[4]])
+        self.assertEqual(report.messages_sent, 6)
+        self.assertEqual(report.get_failed(), [])
+        self.assertEqual(sorted(report.results), addresses)
+
+    def test_resume(self):
+        self.check_resume(1)
+
+    def test_resume_concurrent(self):
+        self.check_resume(3)
@@ -0,0 +1,107 @@
+""" Models, on which export and fill tests are run.
+"""
+
+
+import datetime
+
+from django.db import models
+
+
+def case_insensitive(field):
+    """ Makes SQLite compare values of text field ignoring case, as
+    MySQL does with ``*_ci`` collations. Field stays built-in field, so
+    export handles it as a plain column.
+    """
+    db_type = field.db_type
+    field.db_type = lambda connection: (
+            db_type(connection) + u' COLLATE NOCASE')
+    return field
+
+
+class School(models.Model):
+    """ School.
+    """
+
+    title = models.CharField(max_length=50)
+    city = models.CharField(max_length=50, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.title
+
+
+class Tag(models.Model):
+    """ Tag of student.
+    """
+
+    name = models.CharField(max_length=20)
+
+    def __unicode__(self):
+        return self.name
+
+
+class Student(models.Model):
+    """ Student with foreign key, many to many and reverse relations.
+    """
+
+    first_name = models.CharField(max_length=50)
+    nickname = case_insensitive(
+            models.CharField(max_length=50, blank=True))
+    last_name = models.CharField(max_length=50)
+    birth_date = models.DateField(null=True, blank=True)
+    school = models.ForeignKey(School)
+    mentor_school = models.ForeignKey(
+            School, null=True, blank=True, related_name='mentored')
+    tags = models.ManyToManyField(Tag, blank=True)
+
+    class Meta(object):
+        ordering = ['last_name']
+
+    def __unicode__(self):
+        return self.full_name()
+
+    def full_name(self):
+        """ Returns first and last name.
+        """
+        return u'{0} {1}'.format(self.first_name, self.last_name)
+
+    @property
+    def initials(self):
+        """ First letters of names.
+        """
+        return self.first_name[:1] + self.last_name[:1]
+
+
+class Grade(models.Model):
+    """ Grade of student.
+    """
+
+    student = models.ForeignKey(Student)
+    value = models.IntegerField()
+
+    def __unicode__(self):
+        return unicode(self.value)
+
+
+def create_students(count):
+    """ Creates ``count`` students in two schools.
+    """
+    first = School.objects.create(title=u'First', city=u'Vilnius')
+    second = School.objects.create(title=u'Second')
+    tags = [Tag.objects.create(name=name) for name in (u'a', u'b')]
+    students = []
+    for i in range(count):
+        student = Student.objects.create(
+                first_name=u'Name{0}'.format(i % 7),
+                last_name=u'Last{0}'.format(i % 5),
+                nickname=u'Nick{0}'.format(i % 11),
+                birth_date=(
+                    datetime.date(2000, 1, 1 + i % 28) if i % 4 else None),
+                school=first if i % 2 else second,
+                mentor_school=first if i % 3 == 0 else None)
+        if i % 2:
+            student.tags.add(*tags)
+        for value in range(i % 3):
+            Grade.objects.create(student=student, value=value)
+        students.append(student)
+    return students
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+
+""" Tests of download selection validation and mapping cache.
+"""
+
+
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from nmadb_utils.test import setup_database
+
+
+class DownloadSelectionTest(TestCase):
+    """ Tests of :class:`nmadb_utils.models.DownloadSelection`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(DownloadSelectionTest, cls).setUpClass()
+
+    def create_selection(self, query, model=u'test.Student'):
+        """ Saves selection.
+        """
+        from nmadb_utils.models import DownloadSelection
+        selection = DownloadSelection(
+                title=u'Students', model=model, writer=u'CSV', query=query)
+        selection.save()
+        return selection
+
+    def test_save_validates_query(self):
+        self.assertRaises(
+                ValidationError, self.create_selection,
+                u'Name: first_name\nMissing: school__missing')
+        self.assertRaises(
+                ValidationError, self.create_selection,
+                u'Name: first_name', model=u'test.Missing')
+        selection = self.create_selection(
+                u'Name: first_name\nSchool: school__title')
+        self.assertEqual(
+                selection.get_sheet_mapping(),
+                [(u'Name', (u'first_name',)),
+                 (u'School', (u'school', u'title'))])
+
+    def test_mapping_follows_query(self):
+        from nmadb_utils.models import DownloadSelection
+        selection = self.create_selection(u'Name: first_name')
+        self.assertEqual(
+                selection.get_sheet_mapping(), [(u'Name', (u'first_name',))])
+        # Other instance of the same selection is changed.
+        other = DownloadSelection.objects.get(pk=selection.pk)
+        other.query = u'Last name: last_name'
+        other.save()
+        selection = DownloadSelection.objects.get(pk=selection.pk)
+        self.assertEqual(
+                selection.get_sheet_mapping(),
+                [(u'Last name', (u'last_name',))])
+
+    def test_blank_lines(self):
+        selection = self.create_selection(
+                u'Name: first_name\n\n  \nSchool: school__title\n\n')
+        self.assertEqual(
+                selection.get_sheet_mapping(),
+                [(u'Name', (u'first_name',)),
+                 (u'School', (u'school', u'title'))])
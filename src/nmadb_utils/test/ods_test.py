@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+
+""" Tests of streaming ODS writer and reader.
+"""
+
+
+import StringIO
+import unittest
+import zipfile
+
+from nmadb_utils import ods
+
+
+def make_spreadsheet(tables):
+    """ Returns ODS file, which ``content.xml`` contains given tables
+    XML.
+    """
+    output = StringIO.StringIO()
+    archive = zipfile.ZipFile(output, 'w')
+    archive.writestr('mimetype', ods.MIME_TYPE)
+    archive.writestr(
+            'content.xml', ods.CONTENT_START + tables + ods.CONTENT_END)
+    archive.close()
+    output.seek(0)
+    return output
+
+
+def cell(text, repeated=None):
+    """ Returns XML of string cell.
+    """
+    attributes = ''
+    if repeated is not None:
+        attributes = ' table:number-columns-repeated="{0}"'.format(repeated)
+    if text is None:
+        return '<table:table-cell{0}/>'.format(attributes)
+    return (
+            '<table:table-cell office:value-type="string"{0}>'
+            '<text:p>{1}</text:p></table:table-cell>').format(
+                    attributes, text)
+
+
+def row(cells, repeated=None):
+    """ Returns XML of row.
+    """
+    attributes = ''
+    if repeated is not None:
+        attributes = ' table:number-rows-repeated="{0}"'.format(repeated)
+    return '<table:table-row{0}>{1}</table:table-row>'.format(
+            attributes, ''.join(cells))
+
+
+class ReadRowsTest(unittest.TestCase):
+    """ Tests of :func:`nmadb_utils.ods.read_rows`.
+    """
+
+    def read(self, tables):
+        """ Returns list of rows read from spreadsheet.
+        """
+        return list(ods.read_rows(make_spreadsheet(tables)))
+
+    def test_repeated_cells_and_rows(self):
+        rows = self.read(
+                '<table:table table:name="A">' +
+                row([cell('a', 2), cell(None, 2), cell('b')]) +
+                row([cell('c')], 2) +
+                '</table:table>')
+        self.assertEqual(rows, [
+            (u'A', [u'a', u'a', u'', u'', u'b']),
+            (u'A', [u'c']),
+            (u'A', [u'c']),
+            ])
+
+    def test_trailing_empty_cells_and_rows(self):
+        rows = self.read(
+                '<table:table table:name="A">' +
+                row([cell('a'), cell(None, 1000)]) +
+                row([cell(None, 1000)], 3) +
+                row([cell(None), cell('b')]) +
+                row([cell(None, 1000)], 1000000) +
+                '</table:table>')
+        self.assertEqual(rows, [
+            (u'A', [u'a']),
+            (u'A', []),
+            (u'A', []),
+            (u'A', []),
+            (u'A', [u'', u'b']),
+            ])
+
+    def test_multiple_sheets(self):
+        rows = self.read(
+                '<table:table table:name="A">' +
+                row([cell('a')]) +
+                '</table:table><table:table table:name="B">' +
+                row([cell('b')]) +
+                '</table:table>')
+        self.assertEqual(rows, [(u'A', [u'a']), (u'B', [u'b'])])
+
+    def test_writer_round_trip(self):
+        sheets = [
+                (u'Duomenys', [
+                    [u'Vardas', u'Pastabos'],
+                    [u'\u0160ar\u016bnas', u'a & <b>\nline'],
+                    [u'', u'  spaces\tand tab'],
+                    ]),
+                (u'Kitas & <lapas>', [[u'x']]),
+                ]
+        writer = ods.ODSWriter()
+        output = StringIO.StringIO()
+        try:
+            for name, rows in sheets:
+                writer.write_sheet(name, rows)
+            writer.save(output)
+        finally:
+            writer.close()
+        output.seek(0)
+        self.assertTrue(ods.is_spreadsheet(output))
+        self.assertEqual(list(ods.read_rows(output)), [
+            (name, values) for name, rows in sheets for values in rows])
+
+    def test_is_spreadsheet(self):
+        self.assertFalse(ods.is_spreadsheet(StringIO.StringIO('xx')))
+        output = StringIO.StringIO()
+        archive = zipfile.ZipFile(output, 'w')
+        archive.writestr('mimetype', ods.MIME_TYPE)
+        archive.close()
+        self.assertFalse(ods.is_spreadsheet(output))
+        self.assertTrue(ods.is_spreadsheet(make_spreadsheet('')))
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+
+""" Tests of PDF rendering cache.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils import translation
+from django.utils import tzinfo
+
+import nmadb_utils.test # pylint: disable=W0611
+
+
+class PdfCacheTest(unittest.TestCase):
+    """ Tests of keys and invalidation of :mod:`nmadb_utils.pdf` cache.
+    """
+
+    def setUp(self):
+        from nmadb_utils import pdf
+        self.pdf = pdf
+        self.cache_templates = pdf.PDF_CACHE_TEMPLATES
+        pdf.PDF_CACHE_TEMPLATES = True
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(TEMPLATE_DIRS=(self.directory,))
+        self.settings.enable()
+        self.write_template(u'<p>OLD</p>')
+
+    def tearDown(self):
+        self.pdf.invalidate_pdf_cache(u'document.html')
+        self.settings.disable()
+        self.pdf.PDF_CACHE_TEMPLATES = self.cache_templates
+        shutil.rmtree(self.directory)
+
+    def write_template(self, source):
+        """ Writes source of ``document.html`` template.
+        """
+        with open(os.path.join(self.directory, 'document.html'), 'w') as f:
+            f.write(source)
+
+    def test_key_depends_on_language_and_time_zone(self):
+        keys = set()
+        for language in (u'en', u'lt'):
+            for time_zone in (timezone.utc, tzinfo.FixedOffset(120)):
+                with translation.override(language):
+                    timezone.activate(time_zone)
+                    try:
+                        keys.add(self.pdf.get_pdf_cache_key(
+                            u'document.html', {u'value': 1}))
+                    finally:
+                        timezone.deactivate()
+        self.assertEqual(len(keys), 4)
+
+    def test_invalidate_all(self):
+        key = self.pdf.get_pdf_cache_key(u'document.html', {})
+        self.assertEqual(
+                self.pdf.render_html(u'document.html', {}), u'<p>OLD</p>')
+        self.write_template(u'<p>NEW</p>')
+        self.assertEqual(
+                self.pdf.render_html(u'document.html', {}), u'<p>OLD</p>')
+        self.pdf.invalidate_pdf_cache()
+        self.assertEqual(
+                self.pdf.render_html(u'document.html', {}), u'<p>NEW</p>')
+        self.assertNotEqual(
+                self.pdf.get_pdf_cache_key(u'document.html', {}), key)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+
+""" Tests of signed selection tokens.
+"""
+
+
+from django.core import signing
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from nmadb_utils.test import setup_database
+
+
+URL = '/admin/test/student/'
+
+
+class SelectionTokenTest(TestCase):
+    """ Tests of :mod:`nmadb_utils.selection`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        setup_database()
+        super(SelectionTokenTest, cls).setUpClass()
+
+    def setUp(self):
+        from nmadb_utils import selection
+        from nmadb_utils.test.models import Student, create_students
+        self.selection = selection
+        self.students = create_students(10)
+        self.queryset = Student.objects.all()
+        self.factory = RequestFactory()
+
+    def make_data(self, query, post, queryset=None):
+        """ Creates token on action request and returns its data.
+        """
+        if queryset is None:
+            queryset = self.queryset
+        request = self.factory.post(URL + query, post)
+        token = self.selection.make_token(request, queryset)
+        return self.selection.load_token(token)
+
+    def test_selected_pks(self):
+        pks = [student.pk for student in self.students[2:5]]
+        data = self.make_data(
+                '?school__id__exact=1',
+                {'_selected_action': [unicode(pk) for pk in pks]},
+                self.queryset.filter(pk__in=pks))
+        # Pks are applied to changelist queryset even if filters changed.
+        request = self.factory.post(URL)
+        queryset = self.selection.filter_queryset(
+                request, self.queryset, data)
+        self.assertEqual(
+                sorted(queryset.values_list('pk', flat=True)), sorted(pks))
+
+    def test_select_across(self):
+        data = self.make_data('?school__id__exact=1', {'select_across': '1'})
+        self.assertFalse('pks' in data)
+        request = self.factory.post(URL + '?school__id__exact=1')
+        queryset = self.selection.filter_queryset(
+                request, self.queryset, data)
+        self.assertEqual(queryset.count(), self.queryset.count())
+        request = self.factory.post(URL + '?school__id__exact=2')
+        self.assertRaises(
+                ValueError, self.selection.filter_queryset,
+                request, self.queryset, data)
+
+    def test_other_model(self):
+        from nmadb_utils.test.models import School
+        data = self.make_data('', {'select_across': '1'})
+        request = self.factory.post(URL)
+        self.assertRaises(
+                ValueError, self.selection.filter_queryset,
+                request, School.objects.all(), data)
+
+    def test_invalid_token(self):
+        token = self.selection.make_token(
+                self.factory.post(URL, {'select_across': '1'}),
+                self.queryset)
+        self.assertRaises(
+                signing.BadSignature, self.selection.load_token,
+                token[:-1] + ('A' if token[-1] != 'A' else 'B'))
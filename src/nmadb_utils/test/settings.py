@@ -0,0 +1,33 @@
+""" Django settings used by tests.
+"""
+
+
+import atexit
+import os
+import tempfile
+
+
+DEBUG = False
+
+# File database (instead of in-memory one) is shared with forked worker
+# processes of parallel exports and background jobs.
+DATABASE_FD, DATABASE_PATH = tempfile.mkstemp(
+        prefix='nmadb-utils-test-', suffix='.sqlite3')
+os.close(DATABASE_FD)
+atexit.register(os.remove, DATABASE_PATH)
+
+DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': DATABASE_PATH,
+            },
+        }
+
+INSTALLED_APPS = (
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'nmadb_utils',
+        'nmadb_utils.test',
+        )
+
+SECRET_KEY = 'tests'
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+
+""" Tests of row writers, which encode streamed exports.
+"""
+
+
+import codecs
+import csv
+import unittest
+
+from nmadb_utils import export
+
+
+ROWS = [
+        [u'Vardas', u'Pavard\u0117'],
+        [u'\u0160ar\u016bnas', u'Tab\tand "quotes"'],
+        [u'Line\nbreak', u''],
+        ]
+
+
+def encode(writer, rows, rows_per_chunk):
+    """ Returns whole streamed file.
+    """
+    return ''.join(export.stream_rows(rows, writer, rows_per_chunk))
+
+
+class RowWriterTest(unittest.TestCase):
+    """ Tests of :data:`nmadb_utils.export.ROW_WRITERS`.
+    """
+
+    def test_csv(self):
+        data = encode(export.CSVRowWriter(), ROWS, 2)
+        rows = [
+                [value.decode('utf-8') for value in row]
+                for row in csv.reader(data.splitlines(True))]
+        self.assertEqual(rows, ROWS)
+
+    def test_utf16_tab_single_bom(self):
+        for rows_per_chunk in (1, 2, 100):
+            data = encode(
+                    export.UTF16TabRowWriter(), ROWS * 50, rows_per_chunk)
+            self.assertTrue(data.startswith(codecs.BOM_UTF16))
+            text = data.decode('utf-16')
+            self.assertFalse(u'\ufeff' in text)
+            lines = text.encode('utf-8').splitlines(True)
+            rows = [
+                    [value.decode('utf-8') for value in row]
+                    for row in csv.reader(lines, delimiter='\t')]
+            self.assertEqual(rows, ROWS * 50)
+
+    def test_utf16_tab_empty(self):
+        data = encode(export.UTF16TabRowWriter(), [], 100)
+        self.assertEqual(data, codecs.BOM_UTF16)